@@ -16,6 +16,7 @@ from pst.data.graph import (
     _DEFAULT_CHUNK_SIZE,
     _DEFAULT_EDGE_STRATEGY,
     _SENTINEL_THRESHOLD,
+    EdgeIndexBuilder,
     GenomeGraph,
 )
 from pst.data.utils import (
@@ -106,7 +107,9 @@ class _BaseGenomeDataset(Dataset[GenomeGraphBatch]):
         if self.any_multi_scaffold_genomes():
             logger.info("Multi-scaffold genomes detected.")
 
-        self.edge_create_fn = GenomeGraph._edge_index_create_method(
+        # edge indices are cached by scaffold size, so scaffolds (and fragments) with the
+        # same number of proteins share the same read-only edge index tensor
+        self.edge_index_builder = EdgeIndexBuilder(
             edge_strategy=edge_strategy,
             chunk_size=chunk_size,
             threshold=threshold,
@@ -271,8 +274,10 @@ class _BaseGenomeDataset(Dataset[GenomeGraphBatch]):
 
     def _convert_strand_tensor(self):
         # convert strand array from [-1, 1] -> [0, 1]
-        # this will be used as an idx in a lut embedding
-        self.protein_strand[self.protein_strand == -1] = 0
+        # the strand embedding maps this back to [-1, 1]
+        # store as a bool since that is 8x smaller than int64 both in memory and for the
+        # per-batch host->device copies
+        self.protein_strand = self.protein_strand == 1
 
     def _standardize_indices(
         self, idx: int | slice | Iterable[int]
@@ -307,11 +312,11 @@ class _BaseGenomeDataset(Dataset[GenomeGraphBatch]):
             is_multi_scaffold = bool(self.scaffold_part_of_multiscaffold[index])
 
             try:
-                edge_index = self.edge_create_fn(num_nodes=num_nodes)
+                edge_index = self.edge_index_builder.build(num_nodes)
             except ValueError as e:
                 # this only occurs when the scaffold has 1 protein
                 if is_multi_scaffold or self._fragmented:
-                    edge_index = torch.tensor([[0, 0]]).t().contiguous()
+                    edge_index = GenomeGraph.create_fully_connected_graph(1)
                 else:
                     raise RuntimeError(
                         "Failed to create edge index, since a scaffold only contains 1 protein. "
@@ -1006,17 +1011,6 @@ class LazyGenomeDataset(_BaseGenomeDataset):
             lazy=True,
         )
 
-    def _convert_strand_tensor(self):
-        # [-1, 1] -> [0, 1]
-        super()._convert_strand_tensor()
-
-        # lazy loading suggests that memory is an issue, so we can save 8x memory by
-        # storing the strand tensor as a bool compared to int64
-
-        self.protein_strand = self.protein_strand.bool()
-
-        # then we just need to convert it back when needed for the strand embedding lut
-
     def _get_protein_data(self, idx: Iterable[int]) -> dict[str, list[Tensor]]:
         batched_protein_data = super()._get_protein_data(idx)
 
@@ -1,8 +1,8 @@
-from functools import partial
-from typing import Callable
+import math
+from functools import lru_cache
+from typing import Optional
 
 import torch
-from more_itertools import chunked
 from torch_geometric.data import Data
 
 from pst.typing import EdgeIndexStrategy, OptTensor
@@ -11,8 +11,14 @@ _DEFAULT_EDGE_STRATEGY = EdgeIndexStrategy.chunked
 _DEFAULT_CHUNK_SIZE = 30
 _SENTINEL_THRESHOLD = -1
 _DEFAULT_THRESHOLD = 30
+# max number of unique (strategy, num_nodes, chunk_size, threshold) edge indices to keep
+_EDGE_INDEX_CACHE_SIZE = 1024
 
-EdgeIndexCreateFn = Callable[..., torch.Tensor]
+# NOTE: pyg message passing aggregation and `torch_geometric.utils.softmax` use
+# `Tensor.scatter_add_`/`scatter_reduce`, which require int64 indices, so int32 edge indices
+# cannot currently be used with the attention layers. This should be changed before any edge
+# indices are created since edge indices are cached.
+EDGE_INDEX_DTYPE = torch.long
 
 
 # this is really more of a scaffold-level graph, ie contiguous sequence of proteins
@@ -71,51 +77,85 @@ class GenomeGraph(Data):
         if not override and self.edge_index is not None:
             return
 
+        # the cached edge index is shared across graphs of the same size, which is fine since
+        # pyg Batch offsets the edge index into a new tensor during collation
         self.edge_index = self.create_edge_index(
             num_nodes=self.num_proteins,
             edge_strategy=self._edge_strategy,
             chunk_size=self._chunk_size,
             threshold=self._threshold,
+            copy=False,
         )
 
     @staticmethod
-    def create_fully_connected_graph(num_nodes: int) -> torch.Tensor:
-        # benchmarked several methods, this is significantly the fastest
-        # it is about 7x faster than the next method
-        # for a total of about 18x speedup from the original method
-
-        # it is fastest to just create a dense matrix first
-        # NOTE: dtype is bool, so this should be the most memory efficient
-        # for a full adj matrix
-        adj = torch.ones(num_nodes, num_nodes, dtype=torch.bool)
+    def create_fully_connected_graph(
+        num_nodes: int,
+        *,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> torch.Tensor:
+        # build the (src, dst) pairs directly from a meshgrid instead of materializing
+        # a dense adj matrix and searching it with .nonzero, which requires a sync
+        # on GPU to know the output size
+        # NOTE: self loops are kept, and the edges are in the same row-major order as
+        # the dense adj matrix approach
+        dtype = dtype or EDGE_INDEX_DTYPE
+        nodes = torch.arange(num_nodes, device=device, dtype=dtype)
+        src, dst = torch.meshgrid(nodes, nodes, indexing="ij")
 
         # then we can just convert this to an adjlist like pyg expects
-        edge_index = adj.nonzero(as_tuple=False).t().contiguous()
+        edge_index = torch.stack((src.reshape(-1), dst.reshape(-1)), dim=0)
         return edge_index
 
     @staticmethod
     def filter_edges_by_seq_distance(
         edge_index: torch.Tensor, threshold: int
     ) -> torch.Tensor:
-        distance = torch.abs(edge_index[0] - edge_index[1])
-        local_edge_index = edge_index[:, distance <= threshold].contiguous()
+        # inplace abs reuses the diff buffer instead of allocating a separate distance tensor
+        distance = edge_index[0] - edge_index[1]
+        local_edge_index = edge_index[:, distance.abs_() <= threshold]
         return local_edge_index
 
     @staticmethod
-    def create_sparse_graph(num_nodes: int, threshold: int) -> torch.Tensor:
-        edge_index = GenomeGraph.create_fully_connected_graph(num_nodes)
-        edge_index = GenomeGraph.filter_edges_by_seq_distance(edge_index, threshold)
+    def create_banded_graph(
+        num_nodes: int,
+        threshold: int,
+        *,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> torch.Tensor:
+        # equivalent to filtering a fully connected graph by sequence distance, but only
+        # ever creates the O(N * threshold) edges within the band instead of all O(N^2) edges
+        threshold = min(threshold, num_nodes - 1)
+        dtype = dtype or EDGE_INDEX_DTYPE
+        nodes = torch.arange(num_nodes, device=device, dtype=dtype)
+        band = torch.arange(-threshold, threshold + 1, device=device, dtype=dtype)
+
+        # shape: [N, 2 * threshold + 1]
+        src = nodes.unsqueeze(-1).expand(-1, band.numel())
+        dst = src + band
+
+        # keeps the edges in the same row-major order as the fully connected graph
+        in_bounds = (dst >= 0) & (dst < num_nodes)
+        edge_index = torch.stack((src[in_bounds], dst[in_bounds]), dim=0)
         return edge_index
 
+    @staticmethod
+    def create_sparse_graph(num_nodes: int, threshold: int) -> torch.Tensor:
+        return GenomeGraph.create_banded_graph(num_nodes, threshold)
+
     @staticmethod
     def create_chunked_graph(
         num_nodes: int, chunk_size: int, threshold: int = _SENTINEL_THRESHOLD
     ) -> torch.Tensor:
-        connected_comp = list(chunked(range(num_nodes), n=chunk_size))
         if num_nodes == 1:
             raise ValueError("Cannot create a chunked graph with only 1 node")
+
+        n_chunks = math.ceil(num_nodes / chunk_size)
+        last_chunk_size = num_nodes - (n_chunks - 1) * chunk_size
+
         # don't want any connected components / subgraphs that only have 1 node
-        if len(connected_comp[-1]) == 1:
+        if last_chunk_size == 1:
             # NOTE: this doesn't work for multiscaffold genomes
             # where one scaffold has 1 protein
             # we will let the caller handle this case
@@ -123,48 +163,49 @@ class GenomeGraph(Data):
             # a single-node graph: torch.tensor([[0, 0]]).t().contiguous()
             # This class is more of a contiguous genomic segment representation (scaffold),
             # so it doesn't necessarily know about groups of scaffolds.
-            connected_comp[-2].extend(connected_comp[-1])
-            del connected_comp[-1]
+            n_chunks -= 1
+            last_chunk_size += chunk_size
 
         # False if threshold == -1 or >= chunk_size
         # True if threshold < chunk_size
         filter_edges = not (threshold == _SENTINEL_THRESHOLD or threshold >= chunk_size)
 
-        _edge_index: list[torch.Tensor] = list()
-        offset = 0
-        for cc in connected_comp:
-            cc_num_nodes = len(cc)
-            edges = GenomeGraph.create_fully_connected_graph(cc_num_nodes) + offset
+        def _chunk_template(size: int) -> torch.Tensor:
             if filter_edges:
-                edges = GenomeGraph.filter_edges_by_seq_distance(edges, threshold)
-            _edge_index.append(edges)
-            offset += cc_num_nodes
+                return GenomeGraph.create_banded_graph(size, threshold)
+            return GenomeGraph.create_fully_connected_graph(size)
+
+        # all chunks except the last have the same size, so they all have the same edges
+        # just offset by the chunk start -> build once and broadcast the offsets
+        n_full_chunks = n_chunks - 1
+        if last_chunk_size == chunk_size:
+            n_full_chunks += 1
+
+        if n_full_chunks == 0:
+            # only a single chunk that is not the default chunk size
+            return _chunk_template(last_chunk_size)
+
+        # shape: [2, E_chunk]
+        template = _chunk_template(chunk_size)
+        # shape: [n_full_chunks]
+        offsets = torch.arange(n_full_chunks, dtype=template.dtype) * chunk_size
+        # shape: [2, n_full_chunks, E_chunk] -> [2, n_full_chunks * E_chunk]
+        edge_index = (template.unsqueeze(1) + offsets.view(1, -1, 1)).reshape(2, -1)
+
+        if n_full_chunks < n_chunks:
+            last_chunk = _chunk_template(last_chunk_size) + n_full_chunks * chunk_size
+            edge_index = torch.cat((edge_index, last_chunk), dim=1)
 
-        edge_index = torch.cat(_edge_index, dim=1)
         return edge_index
 
     @staticmethod
-    def _edge_index_create_method(
-        edge_strategy: EdgeIndexStrategy, chunk_size: int, threshold: int
-    ) -> EdgeIndexCreateFn:
-        kwargs = dict()
-        if edge_strategy == EdgeIndexStrategy.sparse:
-            if threshold <= 1:
-                errmsg = (
-                    f"Passed {edge_strategy=}, which requires the `threshold`"
-                    " arg for `create_sparse_graph` to be >1"
-                )
-                raise ValueError(errmsg)
-            kwargs["threshold"] = threshold
-            edge_create_fn = GenomeGraph.create_sparse_graph
-        elif edge_strategy == EdgeIndexStrategy.chunked:
-            kwargs["threshold"] = threshold
-            kwargs["chunk_size"] = chunk_size
-            edge_create_fn = GenomeGraph.create_chunked_graph
-        else:
-            edge_create_fn = GenomeGraph.create_fully_connected_graph
-
-        return partial(edge_create_fn, **kwargs)
+    def _check_edge_strategy_args(edge_strategy: EdgeIndexStrategy, threshold: int):
+        if edge_strategy == EdgeIndexStrategy.sparse and threshold <= 1:
+            errmsg = (
+                f"Passed {edge_strategy=}, which requires the `threshold`"
+                " arg for `create_sparse_graph` to be >1"
+            )
+            raise ValueError(errmsg)
 
     @staticmethod
     def create_edge_index(
@@ -172,10 +213,81 @@ class GenomeGraph(Data):
         edge_strategy: EdgeIndexStrategy,
         chunk_size: int,
         threshold: int,
+        *,
+        copy: bool = True,
     ) -> torch.Tensor:
-        edge_create_fn = GenomeGraph._edge_index_create_method(
-            edge_strategy=edge_strategy, chunk_size=chunk_size, threshold=threshold
+        """Create the edge index for a scaffold graph with `num_nodes` proteins.
+
+        Edge indices only depend on the number of nodes and the edge creation strategy, so
+        they are cached and shared. If `copy=False`, the shared cached tensor is returned,
+        which MUST NOT be modified inplace.
+        """
+        GenomeGraph._check_edge_strategy_args(edge_strategy, threshold)
+
+        # normalize the args that do not affect the edge index to get more cache hits
+        if edge_strategy == EdgeIndexStrategy.full:
+            chunk_size = threshold = _SENTINEL_THRESHOLD
+        elif edge_strategy == EdgeIndexStrategy.sparse:
+            chunk_size = _SENTINEL_THRESHOLD
+
+        edge_index = _cached_edge_index(
+            EdgeIndexStrategy(edge_strategy), num_nodes, chunk_size, threshold
+        )
+
+        if copy:
+            return edge_index.clone()
+        return edge_index
+
+
+@lru_cache(maxsize=_EDGE_INDEX_CACHE_SIZE)
+def _cached_edge_index(
+    edge_strategy: EdgeIndexStrategy, num_nodes: int, chunk_size: int, threshold: int
+) -> torch.Tensor:
+    # lru_cache is thread safe, and exceptions (such as for 1-node chunked graphs) are not cached
+    if edge_strategy == EdgeIndexStrategy.sparse:
+        return GenomeGraph.create_sparse_graph(num_nodes, threshold)
+    elif edge_strategy == EdgeIndexStrategy.chunked:
+        return GenomeGraph.create_chunked_graph(num_nodes, chunk_size, threshold)
+    return GenomeGraph.create_fully_connected_graph(num_nodes)
+
+
+class EdgeIndexBuilder:
+    """Build edge indices for scaffolds that all share the same edge creation strategy.
+
+    Only the number of proteins varies between scaffolds in a dataset, so each unique scaffold
+    size only needs its edge index built once. The returned edge indices are shared, read-only
+    tensors, which is safe since pyg Batch offsets edge indices into a new tensor during
+    collation.
+    """
+
+    def __init__(
+        self,
+        edge_strategy: EdgeIndexStrategy = _DEFAULT_EDGE_STRATEGY,
+        chunk_size: int = _DEFAULT_CHUNK_SIZE,
+        threshold: int = _SENTINEL_THRESHOLD,
+    ):
+        GenomeGraph._check_edge_strategy_args(edge_strategy, threshold)
+
+        self.edge_strategy = EdgeIndexStrategy(edge_strategy)
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self._cache: dict[int, torch.Tensor] = dict()
+
+    def build(self, num_nodes: int) -> torch.Tensor:
+        edge_index = self._cache.get(num_nodes)
+        if edge_index is not None:
+            return edge_index
+
+        edge_index = GenomeGraph.create_edge_index(
+            num_nodes=num_nodes,
+            edge_strategy=self.edge_strategy,
+            chunk_size=self.chunk_size,
+            threshold=self.threshold,
+            copy=False,
         )
 
-        edge_index = edge_create_fn(num_nodes=num_nodes)
+        # bound memory usage for datasets with many unique scaffold sizes
+        if len(self._cache) < _EDGE_INDEX_CACHE_SIZE:
+            self._cache[num_nodes] = edge_index
+
         return edge_index
@@ -44,6 +44,8 @@ class GenomeDataModuleMixin(LightningDataModule, Generic[_BaseConfigType]):
         self,
         config: _BaseConfigType,
         extra_save_hyperparameters: Optional[set[str]] = None,
+        *,
+        dataset: Optional[_BaseGenomeDataset] = None,
         **dataloader_kwargs,
     ):
         if self._is_base_class():
@@ -58,9 +60,12 @@ class GenomeDataModuleMixin(LightningDataModule, Generic[_BaseConfigType]):
 
         super().__init__()
 
-        dataset_cls = LazyGenomeDataset if config.lazy else GenomeDataset
+        if dataset is None:
+            dataset_cls = LazyGenomeDataset if config.lazy else GenomeDataset
+            dataset = dataset_cls(**config.to_dict(include=LazyGenomeDataset._init_arg_names()))
 
-        self.dataset = dataset_cls(**config.to_dict(include=LazyGenomeDataset._init_arg_names()))
+        # a dataset already loaded from the same config can be passed to avoid reloading it
+        self.dataset = dataset
         self.config = config
         self.batch_size = config.batch_size
         self.dataloader_kwargs = dataloader_kwargs
@@ -213,25 +218,44 @@ class GenomeDataModuleMixin(LightningDataModule, Generic[_BaseConfigType]):
 
 ## THIS IS WITHOUT CV
 class GenomeDataModule(GenomeDataModuleMixin[DataConfig]):
-    def __init__(self, config: DataConfig, **dataloader_kwargs):
-        super().__init__(config, **dataloader_kwargs)
+    def __init__(
+        self,
+        config: DataConfig,
+        *,
+        dataset: Optional[_BaseGenomeDataset] = None,
+        **dataloader_kwargs,
+    ):
+        super().__init__(config, dataset=dataset, **dataloader_kwargs)
 
 
 ### THIS IS WITH CV
 class _CrossValGenomeDataModule(
     GenomeDataModuleMixin[CrossValDataConfig],
 ):
-    def __init__(self, config: CrossValDataConfig, **dataloader_kwargs):
+    def __init__(
+        self,
+        config: CrossValDataConfig,
+        *,
+        dataset: Optional[_BaseGenomeDataset] = None,
+        **dataloader_kwargs,
+    ):
         super().__init__(
             config,
             extra_save_hyperparameters={"cv_strategy", "cv_type", "cv_var_name"},
+            dataset=dataset,
             **dataloader_kwargs,
         )
 
 
 class CrossValGenomeDataModule(CrossValidationDataModuleMixin, _CrossValGenomeDataModule):
-    def __init__(self, config: CrossValDataConfig, **dataloader_kwargs):
-        _CrossValGenomeDataModule.__init__(self, config, **dataloader_kwargs)
+    def __init__(
+        self,
+        config: CrossValDataConfig,
+        *,
+        dataset: Optional[_BaseGenomeDataset] = None,
+        **dataloader_kwargs,
+    ):
+        _CrossValGenomeDataModule.__init__(self, config, dataset=dataset, **dataloader_kwargs)
 
         cross_validator_config, dataset_size, group_attr_name, label_attr_name = (
             self._setup_cross_validation()
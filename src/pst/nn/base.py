@@ -1,6 +1,8 @@
+import logging
+import pickle
 import sys
+import zipfile
 from collections.abc import Mapping
-from functools import cached_property
 from pathlib import Path
 from typing import Any, Callable, Generic, Literal, Optional, TypeVar, Union, cast
 
@@ -15,7 +17,7 @@ from transformers import get_linear_schedule_with_warmup
 
 from pst.data.modules import GenomeDataset
 from pst.nn.config import BaseModelConfig
-from pst.nn.layers import PositionalEmbedding
+from pst.nn.layers import PositionalEmbedding, StrandEmbedding
 from pst.nn.models import SetTransformer, SetTransformerDecoder, SetTransformerEncoder
 from pst.typing import (
     EdgeAttnOutput,
@@ -31,6 +33,54 @@ _FIXED_POINTSWAP_RATE = "FIXED_POINTSWAP_RATE"
 _ModelT = TypeVar("_ModelT", SetTransformer, SetTransformerEncoder)
 _BaseConfigT = TypeVar("_BaseConfigT", bound=BaseModelConfig)
 
+logger = logging.getLogger(__name__)
+
+
+def _load_checkpoint(path: str | Path) -> dict[str, Any]:
+    """Load a checkpoint onto the CPU. For checkpoint files saved in the default zipfile
+    format, the tensor storages are memory-mapped, so they are only read from disk when
+    actually used."""
+    # mmap is only supported for zipfile checkpoints loaded from a file path, so legacy
+    # checkpoints and file-like objects are loaded eagerly
+    mmap = isinstance(path, (str, Path)) and zipfile.is_zipfile(path)
+    try:
+        return torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    except pickle.UnpicklingError:
+        # older checkpoints may store arbitrary python objects, such as enums,
+        # in the hyperparameters
+        logger.warning(
+            f"Checkpoint {path} could not be loaded with `weights_only=True`, so it is being "
+            "fully unpickled instead. Only load checkpoints from trusted sources, since "
+            "unpickling can execute arbitrary code."
+        )
+        if not mmap and hasattr(path, "seek"):
+            path.seek(0)  # type: ignore[union-attr]
+        return torch.load(path, map_location="cpu", mmap=mmap, weights_only=False)
+
+
+def _reuse_workspace(workspace: OptTensor, like: torch.Tensor, dim: int) -> torch.Tensor:
+    """Return a persistent workspace tensor with at least `like.size(0)` rows of size `dim`
+    that has the same device and dtype as `like`. The workspace is only reallocated when
+    the batch has more items than any previous batch or the dim, device, or dtype change.
+
+    The workspace is also reallocated when switching into or out of `torch.inference_mode`,
+    since inference tensors cannot be updated in-place outside of inference mode.
+
+    The caller should store the returned workspace for reuse and slice the first
+    `like.size(0)` rows for the current batch.
+    """
+    if (
+        workspace is None
+        or workspace.size(0) < like.size(0)
+        or workspace.size(1) != dim
+        or workspace.device != like.device
+        or workspace.dtype != like.dtype
+        or workspace.is_inference() != torch.is_inference_mode_enabled()
+    ):
+        workspace = like.new_empty(like.size(0), dim)
+
+    return workspace
+
 
 class PositionalStrandEmbeddingModule(L.LightningModule):
     def __init__(self, in_dim: int, embed_scale: int, max_size: int):
@@ -42,20 +92,15 @@ class PositionalStrandEmbeddingModule(L.LightningModule):
         self.positional_embedding = PositionalEmbedding(dim=embedding_dim, max_size=max_size)
 
         # embed +/- gene strand
-        self.strand_embedding = torch.nn.Embedding(num_embeddings=2, embedding_dim=embedding_dim)
+        self.strand_embedding = StrandEmbedding(dim=embedding_dim)
 
         self.extra_embedding_dim = 2 * embedding_dim
 
-    def _convert_strand_if_needed(self, strand: torch.Tensor) -> torch.Tensor:
-        """Convert the strand tensor from bool to long if needed. This is necessary for indexing
-        the strand embeddings."""
-
-        if strand.dtype != torch.long:
-            return strand.long()
-        return strand
+        # reused across inference steps for the concatenated embeddings
+        self._embedding_workspace: OptTensor = None
 
     def internal_embeddings(
-        self, batch: GenomeGraphBatch
+        self, batch: GenomeGraphBatch, *, reuse_workspace: bool = False
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute the strand and positional embeddings for the proteins in the batch.
 
@@ -67,14 +112,24 @@ class PositionalStrandEmbeddingModule(L.LightningModule):
                 edge index, the index pointer, the number of proteins in each genome, etc, that
                 are used for the forward pass of the `SetTransformer` or `SetTransformerEncoder`.
                 This object models the data patterns of PyTorch Geometric graphs.
+            reuse_workspace (bool, optional): when gradients are not needed, write the
+                embeddings into a persistent workspace instead of allocating new tensors.
+                All returned tensors are then views into that workspace and are
+                OVERWRITTEN by the next call, so they should only be used immediately, such
+                as within a single forward pass. Defaults to False.
 
         Returns:
             tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
                 (concatenated embeddings, positional embeddings, strand embeddings)
         """
-        strand = self._convert_strand_if_needed(batch.strand)
-        strand_embed = self.strand_embedding(strand)
-        positional_embed = self.positional_embedding(batch.pos.squeeze())
+        # pos is [num_proteins, 1] from the dataset
+        pos = batch.pos.reshape(-1)
+
+        if reuse_workspace and self._can_fuse_embeddings(batch.x):
+            return self._fused_internal_embeddings(x=batch.x, pos=pos, strand=batch.strand)
+
+        strand_embed = self.strand_embedding(batch.strand)
+        positional_embed = self.positional_embedding(pos)
 
         x_cat = self.concatenate_embeddings(
             x=batch.x, positional_embed=positional_embed, strand_embed=strand_embed
@@ -82,13 +137,47 @@ class PositionalStrandEmbeddingModule(L.LightningModule):
 
         return x_cat, positional_embed, strand_embed
 
+    def _can_fuse_embeddings(self, x: torch.Tensor) -> bool:
+        # `out=` ops do not support autograd, so only fuse when gradients are not needed
+        return not torch.is_grad_enabled() and x.dtype == self.strand_embedding.vec.dtype
+
+    def _fused_internal_embeddings(
+        self, x: torch.Tensor, pos: torch.Tensor, strand: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Write the protein, positional, and strand embeddings directly into a single
+        preallocated tensor instead of allocating each embedding separately and then
+        concatenating them. The returned positional and strand embeddings are views into the
+        concatenated embeddings.
+
+        The concatenated embeddings are a view into a persistent workspace that is overwritten
+        on the next call, so this is only used when gradients are not needed.
+        """
+        in_dim = x.size(-1)
+        embedding_dim = self.positional_embedding.embedding_dim
+
+        x_cat = self._get_embedding_workspace(x, in_dim + self.extra_embedding_dim)
+        x_cat[:, :in_dim] = x
+
+        positional_embed = x_cat[:, in_dim : in_dim + embedding_dim]
+        strand_embed = x_cat[:, in_dim + embedding_dim :]
+
+        torch.index_select(
+            self.positional_embedding.weight, dim=0, index=pos, out=positional_embed
+        )
+        self.strand_embedding(strand, out=strand_embed)
+
+        return x_cat, positional_embed, strand_embed
+
+    def _get_embedding_workspace(self, x: torch.Tensor, dim: int) -> torch.Tensor:
+        self._embedding_workspace = _reuse_workspace(self._embedding_workspace, like=x, dim=dim)
+        return self._embedding_workspace[: x.size(0)]
+
     def masked_embeddings(
         self, batch: MaskedGenomeGraphBatch
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         node_mask = batch.node_mask
         strand = batch.strand[node_mask]
-        strand = self._convert_strand_if_needed(strand)
-        pos = batch.pos.squeeze()[node_mask]
+        pos = batch.pos.reshape(-1)[node_mask]
         x = batch.masked_embeddings
 
         # ok to keep attached to gradient graph since we
@@ -126,6 +215,13 @@ class PositionalStrandEmbeddingModule(L.LightningModule):
             torch.Tensor: concatenated embeddings, shape: [num_proteins, in_dim + 2 * embedding_dim],
                 order: [protein embeddings, positional embeddings, strand embeddings]
         """
+        if torch.is_autocast_enabled() and positional_embed.dtype != x.dtype:
+            # the embedding tables are kept in full precision, but under autocast, keep the
+            # (smaller) precision of the protein embeddings instead of letting torch.cat
+            # upcast the entire concatenated tensor
+            positional_embed = positional_embed.to(x.dtype)
+            strand_embed = strand_embed.to(x.dtype)
+
         x_cat = torch.cat((x, positional_embed, strand_embed), dim=-1)
         return x_cat
 
@@ -168,7 +264,12 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
 
     # keep track of all the valid pretrained model names
     PRETRAINED_MODEL_NAMES = set()
+    # state dict prefixes of the underlying model and the positional and strand embeddings
+    _BASE_PARAM_PREFIXES = ("model.", "positional_embedding.", "strand_embedding.")
     config: _BaseConfigT
+    encoder: SetTransformerEncoder
+    # only set for genome-level models
+    decoder: SetTransformerDecoder
 
     # NOTE: do not change the name of the config var in all subclasses
     def __init__(self, config: _BaseConfigT, model_type: type[_ModelT]) -> None:
@@ -190,9 +291,11 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
         # only needed for saving/loading models
         self.original_config = config
 
-        # deep copy so that embedding size changes do not affect the original config
+        # copy so that embedding size changes do not affect the original config
         # this really only matters for interactive sessions
-        self.config = config.clone(deep=True)
+        # NOTE: only the top-level in_dim and out_dim fields are changed below, so a shallow
+        # copy is enough. The nested sub-configs are shared with the original config.
+        self.config = config.clone(deep=False)
 
         # need all new models to set _FIXED_POINTSWAP_RATE to True
         # this way we know that saved models are using the correct sample rate
@@ -212,23 +315,53 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
             # plus the dim for both the positional and strand embeddings
             self.config.out_dim = self.config.in_dim
 
+        # dump the adjusted config once and reuse it for both the model and the objective
+        config_dict = self.config.to_dict()
+
         # for genomic PST, the model is a SetTransformer
         # for protein PST, the model is a SetTransformerEncoder
-        self.model = self.setup_model(model_type)
+        self.model = self.setup_model(model_type, config_dict=config_dict)
         self.is_genomic = isinstance(self.model, SetTransformer)
 
-        self.criterion = self.setup_objective(**self.config.loss.to_dict())
+        # these are just aliases to layers already registered under self.model, so they are
+        # set directly on the instance dict to avoid registering them as duplicate submodules
+        # in the state dict
+        if self.is_genomic:
+            self.__dict__["encoder"] = self.model.encoder
+            self.__dict__["decoder"] = self.model.decoder
+        else:
+            self.__dict__["encoder"] = self.model
+
+        self.criterion = self.setup_objective(**config_dict["loss"])
+        if self.config.compile:
+            # the losses are short chains of pointwise ops and reductions, so compiling
+            # fuses them into a few kernels instead of launching one per op
+            self.criterion = torch.compile(self.criterion, dynamic=True)  # type: ignore
 
     def _setup_model(
-        self, model_type: type[_ModelT], include: Optional[set[str]] = None, **kwargs
+        self,
+        model_type: type[_ModelT],
+        include: Optional[set[str]] = None,
+        config_dict: Optional[dict[str, Any]] = None,
+        **kwargs,
     ) -> _ModelT:
-        model = model_type(**self.config.to_dict(include=include), **kwargs)
+        if config_dict is None:
+            config_dict = self.config.to_dict()
+
+        if include is not None:
+            config_dict = {key: config_dict[key] for key in include}
+
+        model = model_type(**config_dict, **kwargs)
         if self.config.compile:
-            model: _ModelT = torch.compile(model)  # type: ignore
+            # the number of proteins and edges changes every batch, so compile with dynamic
+            # shapes up front instead of recompiling once for each new batch shape
+            model: _ModelT = torch.compile(model, dynamic=True)  # type: ignore
 
         return model
 
-    def setup_model(self, model_type: type[_ModelT]) -> _ModelT:
+    def setup_model(
+        self, model_type: type[_ModelT], config_dict: Optional[dict[str, Any]] = None
+    ) -> _ModelT:
         # for some reason, typehinting hates if this is part of the if directly
         condition = issubclass(model_type, SetTransformer)
 
@@ -248,7 +381,9 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
             include = {"in_dim", "out_dim", "num_heads", "dropout", "layer_dropout"}
             kwargs = {"n_layers": self.config.n_enc_layers}
 
-        return self._setup_model(model_type, include=include, **kwargs)
+        return self._setup_model(
+            model_type, include=include, config_dict=config_dict, **kwargs
+        )
 
     def setup_objective(self, **kwargs) -> torch.nn.Module | Callable[..., torch.Tensor]:
         """**Must be overridden by subclasses to setup the loss function.**
@@ -299,25 +434,19 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
         """
         if dataset.max_size > self.positional_embedding.max_size:
             self.positional_embedding.expand(dataset.max_size)
-
-    @cached_property
-    def encoder(self) -> SetTransformerEncoder:
-        if isinstance(self.model, SetTransformer):
-            return self.model.encoder
-        return self.model
-
-    @cached_property
-    def decoder(self) -> SetTransformerDecoder:
-        if isinstance(self.model, SetTransformer):
-            return self.model.decoder
-        raise AttributeError("SetTransformerEncoder does not have a decoder")
+            self.max_size = dataset.max_size
 
     def log_loss(self, loss: torch.Tensor, batch_size: int, stage: _STAGE_TYPE):
         """Simple wrapper around the lightning.LightningModule.log method to log the loss."""
+        # log the tensor directly since .item() forces a device->host sync every step
+        loss = loss.detach()
+
+        # the epoch-level loss is what callbacks monitor, so it needs to be synced across
+        # devices, but lightning only reduces it once at the end of the epoch
         self.log(
             f"{stage}_loss",
-            value=loss.item(),
-            on_step=True,
+            value=loss,
+            on_step=False,
             on_epoch=True,
             prog_bar=True,
             logger=True,
@@ -325,6 +454,23 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
             batch_size=batch_size,
         )
 
+        # per-step training loss is only for progress tracking, so don't all-reduce it
+        # every step. val/test losses are only meaningful per epoch
+        # NOTE: lightning converts progress bar metrics to python scalars every step, which
+        # syncs with the device, whereas logger metrics are only transferred every
+        # `log_every_n_steps`
+        if stage == "train":
+            self.log(
+                f"{stage}_loss_step",
+                value=loss,
+                on_step=True,
+                on_epoch=False,
+                prog_bar=False,
+                logger=True,
+                sync_dist=False,
+                batch_size=batch_size,
+            )
+
     def _loss_step(
         self,
         batch: GenomeGraphBatch,
@@ -358,7 +504,9 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
     def _databatch_forward_with_embeddings(
         self, batch: GenomeGraphBatch, return_attention_weights: bool = True
     ) -> GraphAttnOutput | EdgeAttnOutput:
-        x_with_pos_and_strand, _, _ = self.internal_embeddings(batch)
+        x_with_pos_and_strand, _, _ = self.internal_embeddings(
+            batch, reuse_workspace=True
+        )
 
         return self.databatch_forward(
             batch=batch,
@@ -476,11 +624,27 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
             x=x,
             edge_index=batch.edge_index,
             ptr=batch.ptr,
-            batch=batch.batch,
+            batch=self._node_batch(batch),
             node_mask=node_mask,
             return_attention_weights=return_attention_weights,
         )
 
+    @staticmethod
+    def _node_batch(batch: GenomeGraphBatch) -> torch.Tensor:
+        """Get the genome assignment of each protein in the batch, computing it from the
+        `ptr` tensor and caching it on the batch if needed."""
+        if batch.batch is None:
+            # compute once instead of every layer needing to derive it from ptr
+            # NOTE: passing output_size avoids a device->host sync
+            ptr = batch.ptr
+            batch.batch = torch.repeat_interleave(
+                torch.arange(ptr.numel() - 1, device=ptr.device),
+                ptr.diff(),
+                output_size=batch.x.size(0),
+            )
+
+        return batch.batch
+
     def forward(self, batch: GenomeGraphBatch) -> torch.Tensor:
         """**Must be overridden by subclasses to define the forward pass.**
 
@@ -510,44 +674,48 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
         )
         return cast(type[_BaseConfigT], model_config_type)
 
-    def _try_load_state_dict(self, state_dict: dict[str, torch.Tensor], strict: bool = True):
-        try:
-            # just try to load directly
-            self.load_state_dict(state_dict, strict=True)
-        except RuntimeError:
-            # if that fails, then we need to try to see if we are loading a pretrained model
-            # that does not have values for new layers in subclassed models
-
-            # get the base parameters of the SetTransformer or SetTransformerEncoder
-            # along with the positional and strand embeddings
-            base_params = {f"model.{name}" for name, _ in self.model.named_parameters()}
+    def _new_param_names(self) -> set[str]:
+        # the base params are all registered under these prefixes, so any other params
+        # are new layers added by subclasses
+        return {
+            name
+            for name, _ in self.named_parameters()
+            if not name.startswith(self._BASE_PARAM_PREFIXES)
+        }
 
-            # PositionalStrandEmbeddingModuleMixin params
-            for embedding_name in ("positional_embedding", "strand_embedding"):
-                layer: torch.nn.Module = getattr(self, embedding_name)
-                for name, _ in layer.named_parameters():
-                    base_params.add(f"{embedding_name}.{name}")
+    def _try_load_state_dict(self, state_dict: dict[str, torch.Tensor], strict: bool = True):
+        if not self.is_genomic:
+            # encoder-only models do not have a decoder, so skip the decoder weights of
+            # genomic checkpoints entirely
+            state_dict = {
+                name: value
+                for name, value in state_dict.items()
+                if not name.startswith("model.decoder.")
+            }
 
-            # get all new params
-            current_params = {name for name, _ in self.named_parameters()}
+        # load non-strictly once, then check what did not load. Any missing params should only
+        # be the new layers in subclassed models when loading a pretrained model
+        missing, unexpected = map(set, self.load_state_dict(state_dict, strict=False))
 
-            new_params = current_params - base_params
+        if not missing and not unexpected:
+            return
 
-            # now try to load the state dict
-            missing, unexpected = map(set, self.load_state_dict(state_dict, strict=False))
+        # get all new params, ie those not part of the SetTransformer or SetTransformerEncoder
+        # or the positional and strand embeddings
+        new_params = self._new_param_names()
 
-            # missing should be equivalent to the new params if loaded correctly
-            still_missing = new_params - missing
+        # missing should be equivalent to the new params if loaded correctly
+        still_missing = new_params - missing
 
-            if still_missing:
-                raise RuntimeError(
-                    f"Missing parameters: {still_missing} when loading the state dict"
-                )
+        if still_missing:
+            raise RuntimeError(
+                f"Missing parameters: {still_missing} when loading the state dict"
+            )
 
-            if strict and unexpected:
-                raise RuntimeError(
-                    f"Unexpected parameters: {unexpected} when loading the state dict"
-                )
+        if strict and unexpected:
+            raise RuntimeError(
+                f"Unexpected parameters: {unexpected} when loading the state dict"
+            )
 
     @staticmethod
     def _adjust_checkpoint_inplace(ckpt: dict[str, Any]):
@@ -611,7 +779,7 @@ class _BaseProteinSetTransformer(PositionalStrandEmbeddingModule, Generic[_Model
         if model_config_type is None:
             model_config_type = cls._resolve_model_config_type()
 
-        ckpt = torch.load(pretrained_model_name_or_path, map_location="cpu")
+        ckpt = _load_checkpoint(pretrained_model_name_or_path)
         cls._adjust_checkpoint_inplace(ckpt)
 
         # need to merge ckpt["hyper_parameters"] with update_kwargs with nested dicts
@@ -812,36 +980,31 @@ class BaseProteinSetTransformerEncoder(
             # we do not care about the SetTransformerDecoder state dict!!
 
             # we just need to rebuild the state dict to only include the relevant layers
-
-            # get the base parameters of the SetTransformerEncoder from the view of a
-            # ProteinSetTransformer: ie from PST, the encoder is under the field model.encoder.AAA
-            # also get with the positional and strand embeddings
-            params_to_extract = {
-                f"model.encoder.{name}" for name, _ in self.model.named_parameters()
-            }
-
-            # PositionalStrandEmbeddingModuleMixin params
-            for embedding_name in ("positional_embedding", "strand_embedding"):
-                layer: torch.nn.Module = getattr(self, embedding_name)
-                for name, _ in layer.named_parameters():
-                    params_to_extract.add(f"{embedding_name}.{name}")
+            # in a single pass over the checkpoint keys
 
             # from PST, the encoder is under the field model.encoder.AAA
             # but for the protein PST, the expected field is model.AAA
-            new_state_dict = {
-                name.replace("encoder.", ""): state_dict[name] for name in params_to_extract
-            }
+            # the positional and strand embeddings are kept as is
+            encoder_prefix = "model.encoder."
+            embedding_prefixes = ("positional_embedding.", "strand_embedding.")
 
-            # get all new params
-            current_params = {name for name, _ in self.named_parameters()}
+            new_state_dict: dict[str, torch.Tensor] = {}
+            for name, value in state_dict.items():
+                if name.startswith(encoder_prefix):
+                    new_state_dict[f"model.{name[len(encoder_prefix) :]}"] = value
+                elif name.startswith(embedding_prefixes):
+                    new_state_dict[name] = value
 
-            new_params = current_params - new_state_dict.keys()
+            # get all new params, ie those not part of the SetTransformerEncoder or the
+            # positional and strand embeddings
+            new_params = self._new_param_names()
 
             # now try to load the state dict
             missing, unexpected = map(set, self.load_state_dict(new_state_dict, strict=False))
 
-            # missing should be equivalent to the new params if loaded correctly
-            still_missing = new_params - missing
+            # missing should be exactly the new params if loaded correctly, which also
+            # catches encoder or embedding params that were not in the checkpoint
+            still_missing = missing.symmetric_difference(new_params)
 
             if still_missing:
                 raise RuntimeError(
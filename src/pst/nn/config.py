@@ -153,7 +153,7 @@ class BaseModelConfig(AttrsDataclassUtilitiesMixin):
         layer_dropout (float): dropout rate for entire layers, [0.0, 1.0)
         proj_cat (bool): whether to project the concatenated pLM, positional, and strand embeddings
         max_proteins (int): maximum number of proteins in a scaffold
-        compile (bool): whether to compile the model with `torch.compile`
+        compile (bool): whether to compile the model and loss with `torch.compile`
         optimizer (OptimizerConfig): OPTIMIZER
         loss (BaseLossConfig): LOSS
         augmentation (BaseAugmentationConfig): AUGMENTATION
@@ -195,7 +195,7 @@ class BaseModelConfig(AttrsDataclassUtilitiesMixin):
     """maximum number of proteins in a scaffikd"""
 
     compile: bool = False
-    """whether to compile the model with `torch.compile`"""
+    """whether to compile the model and loss with `torch.compile`"""
 
     optimizer: OptimizerConfig = field(factory=OptimizerConfig)
     """OPTIMIZER
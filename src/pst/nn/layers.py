@@ -124,7 +124,9 @@ class MultiheadAttentionConv(MessagePassing, AttentionMixin, NormMixin):
         x = self.normalize(x, self.norm_input, batch)
 
         # shape [N, H * D] -> [N, H, D]
-        query = self.uncat_heads(self.linQ(x))
+        # fold the attention scale into the queries once per node rather than
+        # rescaling every [E, H, D] query-key product in self.message
+        query = self.uncat_heads(self.linQ(x) / self.attention_scale)
         key = self.uncat_heads(self.linK(x))
         value = self.uncat_heads(self.linV(x))
 
@@ -172,8 +174,9 @@ class MultiheadAttentionConv(MessagePassing, AttentionMixin, NormMixin):
     ) -> torch.Tensor:
         # this computes scaled dot-product attention
         # inner term during self-attention
+        # NOTE: query is already scaled in self.forward
         qk = reduce(
-            query_i * key_j / self.attention_scale,
+            query_i * key_j,
             "edges heads dim -> edges heads",
             "sum",
         )
@@ -406,10 +409,64 @@ class PositionalEmbedding(nn.Module):
         self._embedding = nn.Embedding(max_size, dim)
 
     def expand(self, max_size: int):
-        self._embedding = nn.Embedding(max_size, self.embedding_dim)
+        old_weight = self._embedding.weight
+        self._embedding = nn.Embedding(
+            max_size, self.embedding_dim, device=old_weight.device, dtype=old_weight.dtype
+        )
+
+        # keep the already learned positions
+        with torch.no_grad():
+            self._embedding.weight[: self.max_size].copy_(old_weight)
+
+        self.max_size = max_size
+
+    @property
+    def weight(self) -> torch.Tensor:
+        return self._embedding.weight
 
     def forward(self, positional_idx: torch.Tensor) -> torch.Tensor:
-        return self._embedding(positional_idx)
+        # the full table is already materialized, so this is a single gather
+        return self.weight.index_select(0, positional_idx.reshape(-1))
+
+
+class StrandEmbedding(nn.Module):
+    """Embed the binary +/- strand of each protein.
+
+    Since there are only 2 strands, the embedding is parametrized as
+    `bias + sign * vec`, where `sign` is -1 for the negative strand and +1 for the
+    positive strand. This is equivalent to a 2-row lookup table but avoids a gather.
+    """
+
+    def __init__(self, dim: int):
+        super().__init__()
+
+        self.embedding_dim = dim
+        self.vec = nn.Parameter(torch.randn(dim))
+        self.bias = nn.Parameter(torch.zeros(dim))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints stored the strand embeddings as an nn.Embedding(2, dim)
+        # lookup table, which converts exactly to this parametrization
+        legacy_key = f"{prefix}weight"
+        if legacy_key in state_dict:
+            weight = state_dict.pop(legacy_key)
+            neg, pos = weight[0], weight[1]
+            state_dict[f"{prefix}vec"] = (pos - neg) / 2
+            state_dict[f"{prefix}bias"] = (pos + neg) / 2
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _sign(self, strand: torch.Tensor) -> torch.Tensor:
+        # strand is either a bool or a 0/1 integer tensor: [0, 1] -> [-1, 1]
+        # NOTE: out-of-place since .to() returns the input itself if it already has the
+        # same dtype, which would otherwise overwrite the caller's strand data
+        return strand.to(self.vec.dtype).mul(2).sub(1).unsqueeze(-1)
+
+    def forward(self, strand: torch.Tensor, *, out: OptTensor = None) -> torch.Tensor:
+        sign = self._sign(strand)
+        if out is None:
+            return torch.addcmul(self.bias, sign, self.vec)
+        return torch.addcmul(self.bias, sign, self.vec, out=out)
 
 
 class FixedPositionalEncoding(nn.Module):
@@ -6,21 +6,49 @@ from pst.nn.base import (
     _FIXED_POINTSWAP_RATE,
     BaseProteinSetTransformer,
     BaseProteinSetTransformerEncoder,
+    _reuse_workspace,
 )
 from pst.nn.config import (
     GenomeTripletLossModelConfig,
     MaskedLanguageModelingConfig,
     ProteinTripletLossModelConfig,
 )
-from pst.nn.utils.distance import pairwise_euclidean_distance, stacked_batch_chamfer_distance
+from pst.nn.utils.distance import (
+    chamfer_distance_from_min_distances,
+    pairwise_euclidean_distance,
+    stacked_batch_min_distance,
+)
 from pst.nn.utils.loss import (
     AugmentedWeightedTripletLoss,
     MaskedLanguageModelingLoss,
     WeightedTripletLoss,
 )
 from pst.nn.utils.mask import mask_batch
-from pst.nn.utils.sampling import negative_sampling, point_swap_sampling, positive_sampling
-from pst.typing import GenomeGraphBatch
+from pst.nn.utils.sampling import (
+    blockwise_negative_sampling,
+    blockwise_positive_sampling,
+    negative_sampling,
+    point_swap_sampling,
+    positive_sampling,
+)
+from pst.typing import GenomeGraphBatch, OptTensor
+
+# hparams that have been moved between config fields in older checkpoints
+# (old field, new field, hparam names)
+_MOVED_HPARAMS: tuple[tuple[str, str, tuple[str, ...]], ...] = (
+    ("augmentation", "loss", ("sample_scale", "no_negatives_mode")),
+)
+
+
+def _move_hparams_inplace(hparams: dict[str, Any]):
+    for old_field, new_field, hparam_names in _MOVED_HPARAMS:
+        old_hparams = hparams.get(old_field)
+        if not old_hparams:
+            continue
+
+        for hparam_name in hparam_names:
+            if hparam_name in old_hparams:
+                hparams[new_field][hparam_name] = old_hparams.pop(hparam_name)
 
 
 class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConfig]):
@@ -31,6 +59,9 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
         # this only needs to be defined for the config type hint
         super().__init__(config=config)
 
+        # reused across training steps for the point swapped protein embeddings
+        self._point_swap_workspace: OptTensor = None
+
     def setup_objective(self, margin: float, **kwargs) -> AugmentedWeightedTripletLoss:
         return AugmentedWeightedTripletLoss(margin=margin)
 
@@ -45,11 +76,16 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
         # NOTE: we do not adjust the original data at batch.x
         # this lets the augmented data adjust the positional and strand embeddings
         # independently of the original data
-        x, positional_embed, strand_embed = self.internal_embeddings(batch)
+        x, positional_embed, strand_embed = self.internal_embeddings(
+            batch, reuse_workspace=True
+        )
 
         # calculate chamfer distance only based on the plm embeddings
         # want to maximize that signal over strand and positional embeddings
-        setwise_dist, item_flow = stacked_batch_chamfer_distance(batch=batch.x, ptr=batch.ptr)
+        # keep the per-item min distances to reuse for the augmented data
+        set_min_dists, item_flow = stacked_batch_min_distance(batch=batch.x, ptr=batch.ptr)
+        setwise_dist = chamfer_distance_from_min_distances(set_min_dists, batch.ptr)
+        item_flow = item_flow.t()
         setwise_dist_std = setwise_dist.std()
 
         #### REAL DATA ####
@@ -57,11 +93,22 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
         pos_idx = positive_sampling(setwise_dist)
 
         # forward pass
-        y_anchor, _ = self.databatch_forward(
-            batch=batch,
-            return_attention_weights=False,
-            x=x,
-        )
+        if augment_data:
+            # the augmented genomes only depend on the input space positives, so they can go
+            # through the model in the same forward pass as the real genomes
+            x_aug, aug_idx = self._point_swap_augmentation(
+                batch=batch,
+                pos_idx=pos_idx,
+                item_flow=item_flow,
+                positional_embed=positional_embed,
+            )
+            y_anchor, y_aug_pos = self._paired_databatch_forward(batch=batch, x=x, x_aug=x_aug)
+        else:
+            y_anchor, _ = self.databatch_forward(
+                batch=batch,
+                return_attention_weights=False,
+                x=x,
+            )
 
         # negative sampling
         neg_idx, neg_weights = negative_sampling(
@@ -73,16 +120,18 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
             no_negatives_mode=self.config.loss.no_negatives_mode,
         )
 
-        y_pos = y_anchor[pos_idx]
-        y_neg = y_anchor[neg_idx]
+        # index_select is a single gather kernel with a scatter-add backward, whereas
+        # advanced indexing goes through the generic index path
+        y_pos = y_anchor.index_select(0, pos_idx)
+        y_neg = y_anchor.index_select(0, neg_idx)
 
         if augment_data:
-            y_aug_pos, y_aug_neg, aug_neg_weights = self._augmented_forward_step(
+            y_aug_neg, aug_neg_weights = self._augmented_negative_sampling(
                 batch=batch,
-                pos_idx=pos_idx,
                 y_anchor=y_anchor,
-                item_flow=item_flow,
-                positional_embed=positional_embed,
+                y_aug_pos=y_aug_pos,
+                set_min_dists=set_min_dists,
+                aug_idx=aug_idx,
             )
         else:
             y_aug_pos = None
@@ -102,24 +151,33 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
 
         return loss
 
-    def _augmented_forward_step(
+    def _point_swap_augmentation(
         self,
         batch: GenomeGraphBatch,
         pos_idx: torch.Tensor,
-        y_anchor: torch.Tensor,
         item_flow: torch.Tensor,
         positional_embed: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        # the swapped protein embeddings are only copied into x_aug below, so the same buffer
+        # can be reused every step, as long as the protein embeddings are not being trained
+        out: OptTensor = None
+        if not batch.x.requires_grad:
+            self._point_swap_workspace = _reuse_workspace(
+                self._point_swap_workspace, like=batch.x, dim=batch.x.size(-1)
+            )
+            out = self._point_swap_workspace[: batch.x.size(0)]
+
         augmented_batch, aug_idx = point_swap_sampling(
             batch=batch.x,
             pos_idx=pos_idx,
             item_flow=item_flow,
             sizes=batch.num_proteins,
             sample_rate=self.config.augmentation.sample_rate,
+            out=out,
         )
 
         # let strand use original strand for each ptn
-        strand = batch.strand[aug_idx]
+        strand = batch.strand.index_select(0, aug_idx)
         strand_embed = self.strand_embedding(strand)
 
         # however instead of changing the positional idx, just keep the same
@@ -130,15 +188,54 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
             strand_embed=strand_embed,
         )
 
-        y_aug_pos, _ = self.databatch_forward(
-            batch=batch,
+        return x_aug, aug_idx
+
+    def _paired_databatch_forward(
+        self, batch: GenomeGraphBatch, x: torch.Tensor, x_aug: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        if self.training and self.config.layer_dropout > 0.0:
+            # LayerDrop samples the dropped layers once per forward pass, so keep separate
+            # passes for the real and augmented genomes to let each sample their own layers
+            y_anchor, _ = self.databatch_forward(
+                batch=batch, return_attention_weights=False, x=x
+            )
+            y_aug_pos, _ = self.databatch_forward(
+                batch=batch, return_attention_weights=False, x=x_aug
+            )
+            return y_anchor, y_aug_pos
+
+        # the augmented genomes have the exact same graph structure as the real genomes, so
+        # stack them as additional graphs in the batch to use a single forward pass
+        # all normalization, attention, and pooling is per graph, so the real and augmented
+        # genomes do not interact
+        num_proteins = x.size(0)
+        ptr = batch.ptr
+        node_batch = self._node_batch(batch)
+
+        output = self.forward_step(
+            x=torch.cat((x, x_aug)),
+            edge_index=torch.cat((batch.edge_index, batch.edge_index + num_proteins), dim=1),
+            ptr=torch.cat((ptr, ptr[1:] + num_proteins)),
+            batch=torch.cat((node_batch, node_batch + (ptr.numel() - 1))),
             return_attention_weights=False,
-            x=x_aug,
         )
 
+        y_anchor, y_aug_pos = output.out.chunk(2)
+        return y_anchor, y_aug_pos
+
+    def _augmented_negative_sampling(
+        self,
+        batch: GenomeGraphBatch,
+        y_anchor: torch.Tensor,
+        y_aug_pos: torch.Tensor,
+        set_min_dists: torch.Tensor,
+        aug_idx: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
         # NOTE: computing chamfer distance without positional or strand info
-        setdist_real_aug, _ = stacked_batch_chamfer_distance(
-            batch=batch.x, ptr=batch.ptr, other=augmented_batch
+        # the augmented items are just reindexed real items, so their min distances to each
+        # real genome are already known from the real data
+        setdist_real_aug = chamfer_distance_from_min_distances(
+            set_min_dists[:, aug_idx], batch.ptr
         )
 
         aug_neg_idx, aug_neg_weights = negative_sampling(
@@ -149,8 +246,8 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
             no_negatives_mode=self.config.loss.no_negatives_mode,
         )
 
-        y_aug_neg = y_aug_pos[aug_neg_idx]
-        return y_aug_pos, y_aug_neg, aug_neg_weights
+        y_aug_neg = y_aug_pos.index_select(0, aug_neg_idx)
+        return y_aug_neg, aug_neg_weights
 
     @staticmethod
     def _adjust_checkpoint_inplace(ckpt: dict[str, Any]):
@@ -175,9 +272,7 @@ class ProteinSetTransformer(BaseProteinSetTransformer[GenomeTripletLossModelConf
 
         # move sample_scale and no_negatives_mode to the loss field
         # if they are part of the augmentation field
-        for hparam_name in ("sample_scale", "no_negatives_mode"):
-            if hparam_name in hparams["augmentation"]:
-                hparams["loss"][hparam_name] = hparams["augmentation"].pop(hparam_name)
+        _move_hparams_inplace(hparams)
 
     ### need to overwrite these methods to handle when data augmentaton should occur
     def training_step(self, train_batch: GenomeGraphBatch, batch_idx: int):
@@ -209,17 +304,16 @@ class ProteinSetTransformerEncoder(BaseProteinSetTransformerEncoder[ProteinTripl
 
         # NOTE: we do not adjust the original data at batch.x since we need that
         # for triplet sampling
-        x, _, _ = self.internal_embeddings(batch)
+        x, _, _ = self.internal_embeddings(batch, reuse_workspace=True)
 
         # calculate distances only based on the plm embeddings
         # want to maximize that signal over strand and positional embeddings
-        all_pairwise_dist = pairwise_euclidean_distance(batch.x)
-        all_pairwise_dist_std = all_pairwise_dist.std()
 
         ### positive sampling -
         # happens in input pLM embedding space
-        # need to set the diagonal to inf to avoid selecting the same protein as the positive example
-        pos_idx = positive_sampling(all_pairwise_dist)
+        # the [P, P] pairwise distances are streamed in blocks, since only the closest
+        # protein and the std of the distances are needed
+        pos_idx, all_pairwise_dist_std = blockwise_positive_sampling(batch.x)
 
         ### semihard negative sampling -
         # choose the negative example that is closest to positive
@@ -234,8 +328,8 @@ class ProteinSetTransformerEncoder(BaseProteinSetTransformerEncoder[ProteinTripl
             x=x,
         )
 
-        neg_idx, neg_weights = negative_sampling(
-            input_space_pairwise_dist=all_pairwise_dist,
+        neg_idx, neg_weights = blockwise_negative_sampling(
+            input_space_X=batch.x,
             output_embed_X=y_anchor,
             input_space_dist_std=all_pairwise_dist_std,
             pos_idx=pos_idx,
@@ -243,8 +337,8 @@ class ProteinSetTransformerEncoder(BaseProteinSetTransformerEncoder[ProteinTripl
             no_negatives_mode=self.config.loss.no_negatives_mode,
         )
 
-        y_pos = y_anchor[pos_idx]
-        y_neg = y_anchor[neg_idx]
+        y_pos = y_anchor.index_select(0, pos_idx)
+        y_neg = y_anchor.index_select(0, neg_idx)
 
         loss: torch.Tensor = self.criterion(
             y_self=y_anchor,
@@ -266,10 +360,7 @@ class ProteinSetTransformerEncoder(BaseProteinSetTransformerEncoder[ProteinTripl
         if "config" in hparams:
             hparams = hparams["config"]
 
-        if "augmentation" in hparams and hparams["augmentation"]:
-            for hparam_name in ("sample_scale", "no_negatives_mode"):
-                if hparam_name in hparams["augmentation"]:
-                    hparams["loss"][hparam_name] = hparams["augmentation"].pop(hparam_name)
+        _move_hparams_inplace(hparams)
 
 
 class MLMProteinSetTransformer(BaseProteinSetTransformerEncoder[MaskedLanguageModelingConfig]):
@@ -320,7 +411,7 @@ class MLMProteinSetTransformer(BaseProteinSetTransformerEncoder[MaskedLanguageMo
 
         # concatenate positional and strand embeddings
         # the masked embeddings should be [0.0, ..., 0.0, POS_EMBS, STRAND_EMBS]
-        x, _, _ = self.internal_embeddings(batch)
+        x, _, _ = self.internal_embeddings(batch, reuse_workspace=True)
 
         # forward pass
         # y shape: [num_proteins, hidden_dim]
@@ -331,7 +422,7 @@ class MLMProteinSetTransformer(BaseProteinSetTransformerEncoder[MaskedLanguageMo
             x=x,
         )
 
-        y_pos = y[pos_idx]
+        y_pos = y.index_select(0, pos_idx)
         y_pos_weight_denom = 2 * (node_dist_std * self.config.loss.sample_scale) ** 2
         y_pos_weight = torch.exp(-pos_dist / y_pos_weight_denom)
 
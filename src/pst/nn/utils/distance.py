@@ -16,29 +16,114 @@ def pairwise_euclidean_distance(x: torch.Tensor, y: OptTensor = None) -> torch.T
     Returns:
         torch.Tensor: squared Euclidean distance tensor of shape [N, M]
     """
+    # the expansion below cancels catastrophically in half precision, so keep the GEMM in
+    # fp32 like torch.cdist does, even under autocast (ie bf16-mixed training)
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        x = _to_full_precision(x)
+        other = x if y is None else _to_full_precision(y)
+
+        # expand ||x - y||^2 = ||x||^2 - 2 x.y + ||y||^2 so that the squared distances come
+        # from a single GEMM, rather than taking the sqrt in torch.cdist only to square it again
+        x_sq = x.square().sum(dim=-1, keepdim=True)
+        y_sq = x_sq if y is None else other.square().sum(dim=-1, keepdim=True)
+
+        dist = torch.addmm(x_sq, x, other.t(), alpha=-2.0).add_(y_sq.t()).clamp_min_(0.0)
+
     if y is None:
-        y = x
-        dist = torch.cdist(x, y, p=2.0).square().fill_diagonal_(0.0)
-    else:
-        dist = torch.cdist(x, y, p=2.0).square()
+        dist.fill_diagonal_(0.0)
 
     return dist
 
 
-def _stacked_batch_chamfer_distance(
-    all_pairwise_dist: torch.Tensor, ptr: torch.Tensor
+def _to_full_precision(x: torch.Tensor) -> torch.Tensor:
+    if x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
+# max number of items compared at once when computing the stacked batch chamfer distance
+# ie the full [N, M] pairwise distance matrix is streamed in [N, block size] column blocks
+_CHAMFER_BLOCK_SIZE = 8192
+
+
+def stacked_batch_min_distance(
+    batch: torch.Tensor,
+    ptr: torch.Tensor,
+    *,
+    other: OptTensor = None,
+    block_size: int = _CHAMFER_BLOCK_SIZE,
 ) -> PairTensor:
-    min_dists, flow_idx = segment_min_csr(all_pairwise_dist, ptr)
-    mean_dist = segment_mean_csr(min_dists.t(), ptr)
+    """Compute the minimum squared Euclidean distance from every item to each point set
+    stacked into a 2D batch without padding.
 
-    chamfer_dist = mean_dist + mean_dist.t()
-    return chamfer_dist, flow_idx.t()
+    Args:
+        batch (torch.Tensor): tensor of all item features concatenated into
+            a 2D tensor of shape [N, d], where N is the total number of
+            items in all point sets and d is the item embedding dimension.
+        ptr (torch.Tensor): contains pointers to the start of each point
+            set in `batch`. ptr[i] is the start of point set i, and ptr[i+1]
+            is the end of point set i.
+        other (OptTensor, optional): tensor of shape [M, d] with the items to
+            compare to each point set in `batch`. Defaults to None, meaning
+            compare `batch` with itself.
+        block_size (int, optional): max number of items that each item in
+            `batch` is compared to at once. The pairwise item distances are only
+            ever materialized as [N, block_size] blocks, so this bounds the peak
+            memory usage for large batches. Defaults to 8192.
+
+    Returns:
+        tuple[torch.Tensor, torch.Tensor]:
+
+            - min distance tensor, D, shape [batch_size, M]
+              - Dij is the min distance from item j to the items in point set i
+            - argmin tensor, shape [batch_size, M], with the index of the item
+              in `batch` that is the min distance
+    """
+    y = batch if other is None else other
+    num_items = y.size(0)
+
+    if num_items <= block_size:
+        return segment_min_csr(pairwise_euclidean_distance(batch, other), ptr)
+
+    min_dists: list[torch.Tensor] = []
+    flow_idx: list[torch.Tensor] = []
+    for start in range(0, num_items, block_size):
+        dist = pairwise_euclidean_distance(batch, y[start : start + block_size])
+
+        if other is None:
+            # zero the self-comparisons that lie on the diagonal of the full matrix
+            dist.diagonal(offset=-start).zero_()
+
+        block_min_dists, block_flow_idx = segment_min_csr(dist, ptr)
+        min_dists.append(block_min_dists)
+        flow_idx.append(block_flow_idx)
+
+    return torch.cat(min_dists, dim=-1), torch.cat(flow_idx, dim=-1)
+
+
+def chamfer_distance_from_min_distances(
+    min_dists: torch.Tensor, ptr: torch.Tensor
+) -> torch.Tensor:
+    """Compute the Chamfer distance between all point sets from the output of
+    `stacked_batch_min_distance`.
+
+    Args:
+        min_dists (torch.Tensor): min distance tensor, shape [batch_size, M]
+        ptr (torch.Tensor): index pointer of the M compared items into each point set
+
+    Returns:
+        torch.Tensor: chamfer distance tensor, shape [batch_size, batch_size]
+    """
+    mean_dist = segment_mean_csr(min_dists.t(), ptr)
+    return mean_dist + mean_dist.t()
 
 
-# TODO: allow returning the min_distances instead of the chamfer distance
-# will be useful for speeding up augmented negative sampling
 def stacked_batch_chamfer_distance(
-    batch: torch.Tensor, ptr: torch.Tensor, *, other: OptTensor = None
+    batch: torch.Tensor,
+    ptr: torch.Tensor,
+    *,
+    other: OptTensor = None,
+    block_size: int = _CHAMFER_BLOCK_SIZE,
 ) -> PairTensor:
     """Compute Chamfer distance for all point sets stacked into a 2D batch
     without padding.
@@ -50,6 +135,10 @@ def stacked_batch_chamfer_distance(
         ptr (torch.Tensor): contains pointers to the start of each point
             set in `batch`. ptr[i] is the start of point set i, and ptr[i+1]
             is the end of point set i.
+        other (OptTensor, optional): tensor of the same shape as `batch` with
+            the items of a second version of each point set, such as augmented
+            point sets. Defaults to None, meaning compare `batch` with itself.
+        block_size (int, optional): see `stacked_batch_min_distance`. Defaults to 8192.
 
     Returns:
         tuple[torch.Tensor, torch.Tensor]:
@@ -62,8 +151,11 @@ def stacked_batch_chamfer_distance(
 
     # if other is None: chamfer distance for all graphs/sets in the batch
     # else: chamfer distance between real and augmented point sets
-    all_pairwise_dist = pairwise_euclidean_distance(batch, other)
-    return _stacked_batch_chamfer_distance(all_pairwise_dist, ptr)
+    min_dists, flow_idx = stacked_batch_min_distance(
+        batch, ptr, other=other, block_size=block_size
+    )
+    chamfer_dist = chamfer_distance_from_min_distances(min_dists, ptr)
+    return chamfer_dist, flow_idx.t()
 
 
 def pairwise_chamfer_distance(x: torch.Tensor, y: torch.Tensor) -> float:
@@ -14,12 +14,18 @@ class WeightedTripletLoss(nn.Module):
     def __init__(self, margin: float) -> None:
         super(WeightedTripletLoss, self).__init__()
         self.margin = margin
-        self.loss_minimum = torch.tensor(0.0)
 
     @staticmethod
     def squared_distance(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
-        squared_diff = torch.pow(x - y, 2)
-        return einops.reduce(squared_diff, "batch dim -> batch", "sum")
+        # under bf16/fp16 autocast, the model outputs are in half precision, but the
+        # distances are compared against each other and the margin, so they are
+        # accumulated in at least fp32
+        dtype = torch.promote_types(x.dtype, torch.float32)
+
+        # row-wise dot product of the difference with itself without
+        # materializing the squared differences
+        diff = x.to(dtype) - y.to(dtype)
+        return torch.linalg.vecdot(diff, diff, dim=-1)
 
     def forward(
         self,
@@ -43,7 +49,7 @@ class WeightedTripletLoss(nn.Module):
         # class weights also rescale contribution to loss for a weighted average
         # weights are 1.0 for most common class, and all rarer classes are > 1.0
         # this has the effect of amplifying bad performance for rare classes
-        triplet_loss = dist.maximum(self.loss_minimum) * class_weights
+        triplet_loss = dist.clamp_min(0.0) * class_weights
 
         if reduce:
             return average(triplet_loss)
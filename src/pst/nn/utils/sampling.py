@@ -1,9 +1,9 @@
 from typing import Optional
 
 import torch
-from einops import rearrange, reduce
+from einops import rearrange
 
-from pst.nn.utils.distance import pairwise_chamfer_distance
+from pst.nn.utils.distance import pairwise_chamfer_distance, pairwise_euclidean_distance
 from pst.typing import NO_NEGATIVES_MODES, OptTensor, PairTensor
 
 
@@ -35,6 +35,67 @@ def positive_sampling(pairwise_dist: torch.Tensor, clone: bool = False) -> torch
     return masked.argmin(dim=-1)
 
 
+# max number of rows of a pairwise distance matrix materialized at once for blockwise sampling
+# ie the full [N, N] pairwise distance matrix is streamed in [block size, N] row blocks
+_SAMPLING_BLOCK_SIZE = 4096
+
+
+@torch.no_grad()
+def blockwise_positive_sampling(
+    x: torch.Tensor, *, block_size: int = _SAMPLING_BLOCK_SIZE
+) -> PairTensor:
+    """Perform positive sampling using the squared Euclidean distance between all points
+    without materializing the full pairwise distance matrix.
+
+    This is equivalent to computing the pairwise distance with `pairwise_euclidean_distance`,
+    taking its standard deviation, and then calling `positive_sampling`. The pairwise
+    distances are instead computed in row blocks, so the peak memory usage is
+    O(block_size * N) instead of O(N^2).
+
+    Args:
+        x (torch.Tensor): point tensor of shape [N, d]
+        block_size (int, optional): max number of rows of the pairwise distance matrix that
+            are computed at once. Defaults to 4096.
+
+    Returns:
+        PairTensor: (positive sample index tensor, standard deviation of the pairwise distance
+            tensor). The index tensor is of shape [N] and the standard deviation is a scalar
+            tensor that includes the self-comparisons on the diagonal, like
+            `pairwise_euclidean_distance(x).std()` would.
+    """
+    num_points = x.size(0)
+    if num_points <= block_size:
+        pairwise_dist = pairwise_euclidean_distance(x)
+        dist_std = pairwise_dist.std()
+        return positive_sampling(pairwise_dist), dist_std
+
+    pos_idx: list[torch.Tensor] = []
+    # running count, mean, and sum of squared deviations from the mean to compute the
+    # variance by merging blocks with Chan's parallel algorithm
+    count = 0
+    mean: torch.Tensor | float = 0.0
+    m2: torch.Tensor | float = 0.0
+    for start in range(0, num_points, block_size):
+        dist = pairwise_euclidean_distance(x[start : start + block_size], x)
+        # block rows are offset from the diagonal of the full matrix
+        dist.diagonal(offset=start).fill_(0.0)
+
+        block_count = dist.numel()
+        block_var, block_mean = torch.var_mean(dist, correction=0)
+        delta = block_mean - mean
+        total = count + block_count
+        mean = mean + delta * (block_count / total)
+        m2 = m2 + block_var * block_count + delta.square() * (count * block_count / total)
+        count = total
+
+        # don't allow self to be chosen as the positive
+        dist.diagonal(offset=start).fill_(torch.inf)
+        pos_idx.append(dist.argmin(dim=-1))
+
+    dist_std = (m2 / (count - 1)).sqrt()
+    return torch.cat(pos_idx), dist_std
+
+
 def distance_from_index(
     pairwise_dist: torch.Tensor, index: torch.Tensor
 ) -> torch.Tensor:
@@ -52,7 +113,7 @@ def distance_from_index(
     """
     if index.ndim == 1:
         index = rearrange(index, "batch -> batch 1")
-    return pairwise_dist.gather(dim=-1, index=index).squeeze()
+    return pairwise_dist.gather(dim=-1, index=index).squeeze(-1)
 
 
 def _semi_hard_negative_sampling(
@@ -78,6 +139,50 @@ def _semi_hard_negative_sampling(
     return neg_idx
 
 
+def _semi_hard_negative_index(
+    embed_dist: torch.Tensor,
+    pos_idx: torch.Tensor,
+    pos_dists: torch.Tensor,
+    no_negatives_mode: NO_NEGATIVES_MODES,
+) -> PairTensor:
+    # returns the negative index and whether each anchor had negative choices
+    # for the "closest_to_anchor" mode, the negative index of anchors without negative choices
+    # is left to the caller, since that requires knowing which anchors in the FULL batch
+    # do not have negative choices
+    # NOTE: pos_dists is the distance of ALL anchors to their positive, even when embed_dist
+    # is only a block of rows, since it is broadcast along the last dim
+    batch_size = pos_idx.size(0)
+
+    has_neg_choices = (embed_dist > pos_dists).any(dim=-1)
+    dist_from_pos = embed_dist - pos_dists
+
+    # semi-hardish negative mining
+    # neg example is the one that is the next farther after the pos sample
+    # dist = 0.0 is pos_idx, dist < 0.0 is closer than pos,
+    # but we want just farther than pos
+    neg_idx = _semi_hard_negative_sampling(
+        dist_from_pos=dist_from_pos, pos_idx=pos_idx, batch_size=batch_size
+    )
+
+    # all rows are computed for both cases and then selected from, which avoids
+    # branching on data-dependent values that would require a device->host sync
+    if no_negatives_mode == "closest_to_positive":
+        no_neg_neg_idx = _semi_hard_negative_sampling(
+            dist_from_pos=dist_from_pos.abs(), pos_idx=pos_idx, batch_size=batch_size
+        )
+        neg_idx = torch.where(has_neg_choices, neg_idx, no_neg_neg_idx)
+
+    return neg_idx, has_neg_choices
+
+
+def _closest_to_anchor_index(
+    embed_dist: torch.Tensor, has_neg_choices: torch.Tensor
+) -> torch.Tensor:
+    # mask anchors that do not have negative choices
+    dist_from_anchor = embed_dist.masked_fill(has_neg_choices.logical_not(), torch.inf)
+    return dist_from_anchor.argmin(dim=-1)
+
+
 @torch.no_grad()
 def negative_sampling(
     input_space_pairwise_dist: torch.Tensor,
@@ -139,6 +244,9 @@ def negative_sampling(
     if input_space_dist_std is None:
         input_space_dist_std = input_space_pairwise_dist.std()
 
+    if no_negatives_mode not in ("closest_to_positive", "closest_to_anchor"):
+        raise ValueError(f"Invalid strategy passed for no negatives: {no_negatives_mode=}")
+
     if output_embed_Y is None:
         # this chooses the neg sample from the real dataset
         # otherwise, Y is the augmented data, and this will choose from Y
@@ -148,9 +256,8 @@ def negative_sampling(
     else:
         # pos_idx is just aligned already in the case of sampling from point swapped
         # augmented data
-        pos_idx = torch.arange(output_embed_Y.size(0)).to(output_embed_Y.device)
+        pos_idx = torch.arange(output_embed_Y.size(0), device=output_embed_Y.device)
 
-    batch_size = pos_idx.size(0)
     pos_idx = rearrange(pos_idx, "batch -> batch 1")
 
     # in case of sampling from real dataset, diag should be 0 due to self-comparison
@@ -166,50 +273,16 @@ def negative_sampling(
     # this allows dynamically choosing the negative samples as the model learns
     pos_dists = distance_from_index(embed_dist, pos_idx)
 
-    gt_pos = embed_dist > pos_dists
-    has_neg_choices = reduce(gt_pos, "batch1 batch2 -> batch1", "sum").bool()
-    dist_from_pos = embed_dist - pos_dists
+    neg_idx, has_neg_choices = _semi_hard_negative_index(
+        embed_dist=embed_dist,
+        pos_idx=pos_idx,
+        pos_dists=pos_dists,
+        no_negatives_mode=no_negatives_mode,
+    )
 
-    # semi-hardish negative mining
-    if has_neg_choices.all():
-        # neg example is the one that is the next farther after the pos sample
-        # dist = 0.0 is pos_idx, dist < 0.0 is closer than pos,
-        # but we want just farther than pos
-        neg_idx = _semi_hard_negative_sampling(
-            dist_from_pos=dist_from_pos, pos_idx=pos_idx, batch_size=batch_size
-        )
-    else:
-        neg_idx = pos_idx.new_full((batch_size,), fill_value=-1)
-        has_neg_idx = has_neg_choices.nonzero(as_tuple=True)[0]
-        no_neg_idx = has_neg_choices.logical_not().nonzero(as_tuple=True)[0]
-
-        # calc negative for those with proper negative ie negative
-        # is just the next set farther than the positive
-        has_neg_dist_from_pos = dist_from_pos[has_neg_idx]
-        has_neg_neg_idx = _semi_hard_negative_sampling(
-            dist_from_pos=has_neg_dist_from_pos,
-            pos_idx=pos_idx[has_neg_idx],
-            batch_size=None,
-        )
-        neg_idx[has_neg_idx] = has_neg_neg_idx
-
-        if no_negatives_mode == "closest_to_positive":
-            no_neg_dist_from_pos = dist_from_pos[no_neg_idx].abs()
-            no_neg_neg_idx = _semi_hard_negative_sampling(
-                dist_from_pos=no_neg_dist_from_pos,
-                pos_idx=pos_idx[no_neg_idx],
-                batch_size=None,
-            )
-        elif no_negatives_mode == "closest_to_anchor":
-            dist_from_anchor = embed_dist[no_neg_idx]
-            # mask anchor
-            dist_from_anchor[:, no_neg_idx] = torch.inf
-            no_neg_neg_idx = dist_from_anchor.argmin(dim=-1)
-        else:
-            raise ValueError(
-                f"Invalid strategy passed for no negatives: {no_negatives_mode=}"
-            )
-        neg_idx[no_neg_idx] = no_neg_neg_idx
+    if no_negatives_mode == "closest_to_anchor":
+        no_neg_neg_idx = _closest_to_anchor_index(embed_dist, has_neg_choices)
+        neg_idx = torch.where(has_neg_choices, neg_idx, no_neg_neg_idx)
 
     # calc negative sample weight
     neg_setwise_dists = input_space_pairwise_dist.gather(
@@ -221,12 +294,117 @@ def negative_sampling(
     return neg_idx, neg_weight
 
 
+@torch.no_grad()
+def blockwise_negative_sampling(
+    input_space_X: torch.Tensor,
+    output_embed_X: torch.Tensor,
+    input_space_dist_std: torch.Tensor | float,
+    pos_idx: torch.Tensor,
+    *,
+    scale: float = 7.0,
+    no_negatives_mode: NO_NEGATIVES_MODES = "closest_to_positive",
+    block_size: int = _SAMPLING_BLOCK_SIZE,
+) -> PairTensor:
+    """Sample negative examples from the real dataset for triplet loss using the same
+    semi-hard negative sampling strategy as `negative_sampling` without materializing the full
+    pairwise distance matrices of either the input or output embeddings.
+
+    The output embedding distances are computed in row blocks, so the peak memory usage is
+    O(block_size * N) instead of O(N^2). The input space distances are only needed for the
+    chosen negatives, so they are computed directly from the input embeddings.
+
+    Args:
+        input_space_X (torch.Tensor): INPUT embeddings, shape: [N, d]. These should be the
+            same embeddings used for the positive sampling.
+        output_embed_X (torch.Tensor): output embeddings of the model, shape: [N, D]
+        input_space_dist_std (torch.Tensor | float): standard deviation of the INPUT space
+            pairwise squared Euclidean distance, such as from `blockwise_positive_sampling`
+        pos_idx (torch.Tensor): index tensor where the value j at the ith position
+            specifies the positive neighbor j for the ith input, shape: [N]
+        scale (float, optional): negative exponential decay scale factor. Defaults to 7.0.
+        no_negatives_mode (NO_NEGATIVES_MODES, optional): strategy for handling instances where
+            no negatives exist. See `negative_sampling` for details. Defaults to
+            "closest_to_positive".
+        block_size (int, optional): max number of rows of the output embedding pairwise
+            distance matrix that are computed at once. Defaults to 4096.
+
+    Raises:
+        ValueError: if an invalid strategy is passed for no_negatives_mode is passed. Valid
+            options are "closest_to_positive" and "closest_to_anchor".
+
+    Returns:
+        PairTensor: (negative sample index tensor, negative sample weight tensor), both of
+            shape [N]
+    """
+    if no_negatives_mode not in ("closest_to_positive", "closest_to_anchor"):
+        raise ValueError(f"Invalid strategy passed for no negatives: {no_negatives_mode=}")
+
+    num_points = output_embed_X.size(0)
+    pos_idx = rearrange(pos_idx, "batch -> batch 1")
+    starts = range(0, num_points, block_size)
+
+    # with a single block, the full output embedding pairwise distance is computed once
+    # otherwise, each row block is recomputed in every pass below
+    full_embed_dist = (
+        torch.cdist(output_embed_X, output_embed_X) if num_points <= block_size else None
+    )
+
+    def embed_dist_block(start: int) -> torch.Tensor:
+        if full_embed_dist is not None:
+            return full_embed_dist
+        return torch.cdist(output_embed_X[start : start + block_size], output_embed_X)
+
+    # the distance of EVERY anchor to its positive is needed before any block can be sampled
+    # from, since these are compared along the last dim of each block
+    pos_dists = torch.cat(
+        [
+            distance_from_index(embed_dist_block(start), pos_idx[start : start + block_size])
+            for start in starts
+        ]
+    )
+
+    neg_idx_blocks: list[torch.Tensor] = []
+    has_neg_choices_blocks: list[torch.Tensor] = []
+    for start in starts:
+        neg_idx, has_neg_choices = _semi_hard_negative_index(
+            embed_dist=embed_dist_block(start),
+            pos_idx=pos_idx[start : start + block_size],
+            pos_dists=pos_dists,
+            no_negatives_mode=no_negatives_mode,
+        )
+        neg_idx_blocks.append(neg_idx)
+        has_neg_choices_blocks.append(has_neg_choices)
+
+    neg_idx = torch.cat(neg_idx_blocks)
+    has_neg_choices = torch.cat(has_neg_choices_blocks)
+
+    if no_negatives_mode == "closest_to_anchor":
+        # this also requires knowing which anchors in the full batch do not have negative
+        # choices, so it needs another pass
+        no_neg_neg_idx = torch.cat(
+            [
+                _closest_to_anchor_index(embed_dist_block(start), has_neg_choices)
+                for start in starts
+            ]
+        )
+        neg_idx = torch.where(has_neg_choices, neg_idx, no_neg_neg_idx)
+
+    # calc negative sample weight
+    neg_setwise_dists = (input_space_X - input_space_X[neg_idx]).square().sum(dim=-1)
+    denom = 2 * (scale * input_space_dist_std) ** 2
+    neg_weight = torch.exp(-neg_setwise_dists / denom)
+
+    return neg_idx, neg_weight
+
+
 def point_swap_sampling(
     batch: torch.Tensor,
     pos_idx: torch.Tensor,
     item_flow: torch.Tensor,
     sizes: torch.Tensor,
     sample_rate: float,
+    *,
+    out: OptTensor = None,
 ) -> PairTensor:
     """Perform point swap sampling data augmentation.
 
@@ -241,6 +419,8 @@ def point_swap_sampling(
             in set j
         sizes (torch.Tensor): shape: [batch_size], size of each point set
         sample_rate (float): rate of point swapping, (0.0, 1.0)
+        out (OptTensor, optional): preallocated tensor with the same shape as `batch` to
+            write the augmented batch into. Defaults to None, meaning allocate a new tensor.
 
     Returns:
         PairTensor: augmented batch and the indices of the nodes that were
@@ -249,16 +429,22 @@ def point_swap_sampling(
     if sample_rate <= 0.0 or sample_rate >= 1.0:
         raise ValueError(f"Provided {sample_rate=} must be in the range (0.0, 1.0)")
 
-    pos_idx = pos_idx.repeat_interleave(sizes).unsqueeze(1)
-    aug_idx = item_flow.gather(dim=1, index=pos_idx).squeeze()
+    # the total number of items is already known, so passing it avoids a device->host sync
+    # that repeat_interleave would otherwise need to size the output
+    num_items = batch.size(0)
+    pos_idx = pos_idx.repeat_interleave(sizes, output_size=num_items).unsqueeze(1)
+    aug_idx = item_flow.gather(dim=1, index=pos_idx).squeeze(1)
 
     # sample from uniform [0, 1) distribution to determine whether to swap
     # True = should swap, False = should not swap
-    mask = torch.rand(aug_idx.size(0), device=aug_idx.device) < sample_rate
-    default = torch.arange(aug_idx.size(0), device=aug_idx.device)
+    mask = torch.rand(num_items, device=aug_idx.device) < sample_rate
+    default = torch.arange(num_items, device=aug_idx.device)
     aug_idx = torch.where(mask, aug_idx, default)
 
-    augmented_batch = batch[aug_idx]
+    if out is None:
+        augmented_batch = batch.index_select(0, aug_idx)
+    else:
+        augmented_batch = torch.index_select(batch, 0, aug_idx, out=out)
     return augmented_batch, aug_idx
 
 
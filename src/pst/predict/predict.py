@@ -488,7 +488,7 @@ class Predictor:
         for batch in tqdm(dataloader, file=sys.stdout):
             batch = batch.to(self.device)  # type: ignore
 
-            x_cat, _, _ = self.model.internal_embeddings(batch)
+            x_cat, _, _ = self.model.internal_embeddings(batch, reuse_workspace=True)
 
             node_output: EdgeAttnOutput = self.model.encoder(
                 x_cat, batch.edge_index, batch.batch
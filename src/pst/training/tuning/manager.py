@@ -57,8 +57,10 @@ class StudyManager:
         for study in storage.get_all_studies():
             # have to do this with storage again since study is a FrozenStudy
             # which doesn't have the get_trials method
+            # NOTE: the trials are only read to be added to another study, and this
+            # storage is not reused, so there is no need to deepcopy every trial
             for trial in storage.get_all_trials(
-                study_id=study._study_id, deepcopy=True
+                study_id=study._study_id, deepcopy=False
             ):
                 yield trial
 
@@ -1,10 +1,13 @@
 import logging
 from functools import partial
+from typing import Any, Optional, cast
 
 import optuna
 from lightning_cv.tuning import OptunaHyperparameterLogger, Tuner
+from lightning_cv.utils.serde import config_deserializer
 
 from pst.data.config import CrossValDataConfig
+from pst.data.dataset import _BaseGenomeDataset
 from pst.data.modules import CrossValGenomeDataModule
 from pst.nn.base import BaseModelTypes
 from pst.nn.config import BaseModelConfig
@@ -21,12 +24,40 @@ logger = logging.getLogger(__name__)
 
 class _PatchedTuner(Tuner):
     # this is to patch in the weights for PST for backwards compatibility
+    # and to share the loaded dataset across trials
 
-    def _create_datamodule(self):
-        datamodule = super()._create_datamodule()
+    # data config fields that only affect the dataloaders, not the loaded dataset
+    _DATALOADER_ONLY_FIELDS = frozenset({"batch_size"})
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shared_dataset: Optional[_BaseGenomeDataset] = None
+        self._shared_dataset_key: Optional[dict[str, Any]] = None
+
+    def _create_datamodule(self) -> CrossValGenomeDataModule:
+        # these should have already been updated, but check just in case
+        self._check_hparams_updated()
+        data_config: CrossValDataConfig = config_deserializer(
+            self.trial_updater.data, self.data_config_type
+        )
+
+        # loading the dataset is the expensive part of creating the datamodule, so reuse the
+        # dataset from a previous trial if none of the trialed values changed it
+        datamodule_type = cast(type[CrossValGenomeDataModule], self.datamodule_type)
+        dataset_key = data_config.to_dict(exclude=set(self._DATALOADER_ONLY_FIELDS))
+        if self._shared_dataset is not None and self._shared_dataset_key == dataset_key:
+            # the group weights were already registered when this dataset was loaded
+            return datamodule_type(data_config, dataset=self._shared_dataset)
+
+        datamodule = datamodule_type(data_config)
 
         if self.model_type is ProteinSetTransformer:
-            _add_group_weights(datamodule)  # type: ignore
+            _add_group_weights(datamodule)
+
+        # lazy datasets are not shared since their file handles are closed upon teardown
+        if not datamodule.dataset.lazy:
+            self._shared_dataset = datamodule.dataset
+            self._shared_dataset_key = dataset_key
 
         return datamodule
 
@@ -1,8 +1,12 @@
+from functools import cache
 from typing import Optional, TypeVar, get_type_hints
 
 _T = TypeVar("_T")
 
 
+# the config type annotations are fixed once a class is defined, so only resolve them once
+# per class since get_type_hints is relatively slow and this is called every model init
+@cache
 def _resolve_config_type_from_init(
     cls, config_name: str = "config", default: Optional[_T] = None
 ):
@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from pst.nn.utils.distance import (
+    pairwise_chamfer_distance,
+    stacked_batch_chamfer_distance,
+)
+
+# unequal point set sizes, including a single-item set
+SIZES = [3, 5, 1, 4, 2]
+DIM = 6
+
+
+@pytest.fixture
+def stacked_batch() -> tuple[torch.Tensor, torch.Tensor]:
+    generator = torch.Generator().manual_seed(0)
+    sizes = torch.tensor(SIZES)
+    ptr = torch.zeros(len(SIZES) + 1, dtype=torch.long)
+    ptr[1:] = sizes.cumsum(0)
+    # large values so that the self-distances are not exactly zero without the diagonal
+    # masking, due to cancellation in ||x||^2 - 2 x.x + ||x||^2
+    batch = 100.0 * torch.randn(int(ptr[-1]), DIM, generator=generator)
+    return batch, ptr
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7])
+def test_blockwise_chamfer_distance_matches_full(stacked_batch, block_size: int):
+    batch, ptr = stacked_batch
+    num_items = batch.size(0)
+
+    expected_dist, expected_flow = stacked_batch_chamfer_distance(
+        batch, ptr, block_size=num_items
+    )
+    chamfer_dist, flow = stacked_batch_chamfer_distance(batch, ptr, block_size=block_size)
+
+    # different block sizes use different GEMM shapes, which may round differently
+    torch.testing.assert_close(chamfer_dist, expected_dist, rtol=1e-4, atol=1e-3)
+    torch.testing.assert_close(flow, expected_flow)
+
+    # every item is closest to itself in its own point set
+    torch.testing.assert_close(
+        chamfer_dist.diagonal(), torch.zeros(len(SIZES)), rtol=0.0, atol=0.0
+    )
+    own_set = torch.repeat_interleave(torch.arange(len(SIZES)), torch.tensor(SIZES))
+    torch.testing.assert_close(
+        flow[torch.arange(num_items), own_set], torch.arange(num_items)
+    )
+
+    # compare with the chamfer distance computed independently for each pair of point sets
+    sets = batch.split(SIZES)
+    for i, x in enumerate(sets):
+        for j, y in enumerate(sets):
+            assert chamfer_dist[i, j].item() == pytest.approx(
+                pairwise_chamfer_distance(x, y), rel=1e-4
+            )
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7])
+def test_blockwise_chamfer_distance_with_other_matches_full(
+    stacked_batch, block_size: int
+):
+    batch, ptr = stacked_batch
+    batch = batch.double()
+    other = batch + torch.randn(
+        batch.shape, generator=torch.Generator().manual_seed(1), dtype=batch.dtype
+    )
+
+    expected_dist, expected_flow = stacked_batch_chamfer_distance(
+        batch, ptr, other=other, block_size=batch.size(0)
+    )
+    chamfer_dist, flow = stacked_batch_chamfer_distance(
+        batch, ptr, other=other, block_size=block_size
+    )
+
+    torch.testing.assert_close(chamfer_dist, expected_dist)
+    torch.testing.assert_close(flow, expected_flow)
@@ -0,0 +1,36 @@
+import torch
+from torch_geometric.data import Data
+
+from pst.nn.base import PositionalStrandEmbeddingModule
+
+IN_DIM = 8
+MAX_SIZE = 16
+
+
+def _make_batch(num_proteins: int) -> Data:
+    return Data(
+        x=torch.randn(num_proteins, IN_DIM),
+        pos=torch.randint(0, MAX_SIZE, (num_proteins, 1)),
+        strand=torch.randint(0, 2, (num_proteins,)),
+    )
+
+
+def test_embedding_workspace_inference_mode_then_no_grad():
+    module = PositionalStrandEmbeddingModule(
+        in_dim=IN_DIM, embed_scale=2, max_size=MAX_SIZE
+    )
+    module.eval()
+    batch = _make_batch(num_proteins=10)
+
+    with torch.no_grad():
+        expected, _, _ = module.internal_embeddings(batch)
+
+    # lightning runs validation/test/predict in inference mode by default, so the
+    # workspace is first allocated as an inference tensor
+    with torch.inference_mode():
+        x_cat, _, _ = module.internal_embeddings(batch, reuse_workspace=True)
+        torch.testing.assert_close(x_cat, expected)
+
+    with torch.no_grad():
+        x_cat, _, _ = module.internal_embeddings(batch, reuse_workspace=True)
+        torch.testing.assert_close(x_cat, expected)
@@ -0,0 +1,23 @@
+import torch
+from torch import nn
+
+from pst.nn.layers import StrandEmbedding
+
+
+def test_strand_embedding_loads_legacy_embedding_table():
+    dim = 8
+    # older checkpoints stored the strand embeddings as a 2-row lookup table
+    legacy = nn.Embedding(2, dim)
+
+    model = nn.Module()
+    model.strand_embedding = StrandEmbedding(dim=dim)
+    model.load_state_dict(
+        {"strand_embedding.weight": legacy.weight.detach().clone()}, strict=True
+    )
+
+    strand = torch.tensor([0, 1, 1, 0, 1])
+    expected = legacy(strand)
+
+    with torch.no_grad():
+        for strand_input in (strand, strand.bool()):
+            torch.testing.assert_close(model.strand_embedding(strand_input), expected)
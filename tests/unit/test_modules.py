@@ -0,0 +1,84 @@
+from unittest.mock import patch
+
+import pytest
+import torch
+from torch_geometric.data import Batch
+
+from pst.data.graph import GenomeGraph
+from pst.nn.config import GenomeTripletLossModelConfig
+from pst.nn.modules import ProteinSetTransformer
+
+IN_DIM = 16
+# number of proteins in each genome
+SIZES = [3, 5, 2, 4]
+
+
+def _make_batch() -> Batch:
+    generator = torch.Generator().manual_seed(0)
+    graphs: list[GenomeGraph] = []
+    for label, size in enumerate(SIZES):
+        graph = GenomeGraph(
+            x=torch.randn(size, IN_DIM, generator=generator),
+            strand=torch.randint(0, 2, (size,), generator=generator),
+            num_proteins=size,
+            pos=torch.arange(size).unsqueeze(-1),
+            scaffold_label=label,
+            genome_label=label,
+        )
+        graph.set_edge_index()
+        graphs.append(graph)
+
+    return Batch.from_data_list(graphs)
+
+
+def _make_model(layer_dropout: float = 0.0) -> ProteinSetTransformer:
+    torch.manual_seed(0)
+    config = GenomeTripletLossModelConfig(
+        in_dim=IN_DIM,
+        num_heads=4,
+        n_enc_layers=2,
+        dropout=0.0,
+        layer_dropout=layer_dropout,
+    )
+    return ProteinSetTransformer(config)
+
+
+@pytest.mark.parametrize("training", [True, False])
+def test_paired_databatch_forward_matches_separate_passes(training: bool):
+    model = _make_model()
+    model.train(training)
+    batch = _make_batch()
+
+    with torch.no_grad():
+        x, _, _ = model.internal_embeddings(batch)
+        x_aug = x + torch.randn(x.shape, generator=torch.Generator().manual_seed(1))
+
+        y_anchor, y_aug_pos = model._paired_databatch_forward(
+            batch=batch, x=x, x_aug=x_aug
+        )
+
+        expected_y_anchor, _ = model.databatch_forward(batch=batch, x=x)
+        expected_y_aug_pos, _ = model.databatch_forward(batch=batch, x=x_aug)
+
+    torch.testing.assert_close(y_anchor, expected_y_anchor)
+    torch.testing.assert_close(y_aug_pos, expected_y_aug_pos)
+
+
+def test_paired_databatch_forward_uses_separate_passes_with_layer_dropout():
+    # each pass should sample its own dropped layers
+    model = _make_model(layer_dropout=0.5)
+    model.train()
+    batch = _make_batch()
+
+    with torch.no_grad():
+        x, _, _ = model.internal_embeddings(batch)
+
+        with patch.object(
+            model, "databatch_forward", wraps=model.databatch_forward
+        ) as databatch_forward:
+            y_anchor, y_aug_pos = model._paired_databatch_forward(
+                batch=batch, x=x, x_aug=x
+            )
+
+    assert databatch_forward.call_count == 2
+    assert y_anchor.shape == y_aug_pos.shape == (len(SIZES), model.config.out_dim)
@@ -0,0 +1,130 @@
+import pytest
+import torch
+
+from pst.nn.utils.distance import pairwise_euclidean_distance
+from pst.nn.utils.sampling import (
+    blockwise_negative_sampling,
+    blockwise_positive_sampling,
+    negative_sampling,
+    positive_sampling,
+)
+from pst.typing import NO_NEGATIVES_MODES
+
+NUM_POINTS = 20
+INPUT_DIM = 8
+OUTPUT_DIM = 4
+# block sizes that do and do not evenly divide the number of points, and a single block
+BLOCK_SIZES = [1, 3, 7, 10, NUM_POINTS]
+NO_NEGATIVES_MODE_CHOICES = ["closest_to_positive", "closest_to_anchor"]
+
+
+@pytest.fixture
+def input_space_X() -> torch.Tensor:
+    # continuous random inputs so that there are no distance ties
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(NUM_POINTS, INPUT_DIM, generator=generator, dtype=torch.float64)
+
+
+@pytest.fixture
+def output_embed_X() -> torch.Tensor:
+    generator = torch.Generator().manual_seed(1)
+    return torch.randn(NUM_POINTS, OUTPUT_DIM, generator=generator, dtype=torch.float64)
+
+
+def _full_positive_sampling(
+    x: torch.Tensor,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    pairwise_dist = pairwise_euclidean_distance(x)
+    # the std must be computed before the diagonal is masked by positive sampling
+    dist_std = pairwise_dist.std()
+    pos_idx = positive_sampling(pairwise_dist.clone())
+    return pairwise_dist, pos_idx, dist_std
+
+
+def _check_negative_sampling(
+    input_space_X: torch.Tensor,
+    pairwise_dist: torch.Tensor,
+    dist_std: torch.Tensor,
+    output_embed_X: torch.Tensor,
+    pos_idx: torch.Tensor,
+    block_size: int,
+    no_negatives_mode: NO_NEGATIVES_MODES,
+):
+    expected_neg_idx, expected_neg_weight = negative_sampling(
+        input_space_pairwise_dist=pairwise_dist,
+        output_embed_X=output_embed_X,
+        input_space_dist_std=dist_std,
+        pos_idx=pos_idx,
+        no_negatives_mode=no_negatives_mode,
+    )
+
+    neg_idx, neg_weight = blockwise_negative_sampling(
+        input_space_X=input_space_X,
+        output_embed_X=output_embed_X,
+        input_space_dist_std=dist_std,
+        pos_idx=pos_idx,
+        no_negatives_mode=no_negatives_mode,
+        block_size=block_size,
+    )
+
+    torch.testing.assert_close(neg_idx, expected_neg_idx)
+    torch.testing.assert_close(neg_weight, expected_neg_weight)
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_blockwise_positive_sampling_matches_full(input_space_X, block_size: int):
+    _, expected_pos_idx, expected_std = _full_positive_sampling(input_space_X)
+
+    pos_idx, dist_std = blockwise_positive_sampling(input_space_X, block_size=block_size)
+
+    torch.testing.assert_close(pos_idx, expected_pos_idx)
+    torch.testing.assert_close(dist_std, expected_std)
+
+
+@pytest.mark.parametrize("no_negatives_mode", NO_NEGATIVES_MODE_CHOICES)
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_blockwise_negative_sampling_matches_full(
+    input_space_X, output_embed_X, block_size: int, no_negatives_mode: NO_NEGATIVES_MODES
+):
+    pairwise_dist, pos_idx, dist_std = _full_positive_sampling(input_space_X)
+    _check_negative_sampling(
+        input_space_X=input_space_X,
+        pairwise_dist=pairwise_dist,
+        dist_std=dist_std,
+        output_embed_X=output_embed_X,
+        pos_idx=pos_idx,
+        block_size=block_size,
+        no_negatives_mode=no_negatives_mode,
+    )
+
+
+@pytest.mark.parametrize("no_negatives_mode", NO_NEGATIVES_MODE_CHOICES)
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_blockwise_negative_sampling_without_negatives_matches_full(
+    input_space_X, block_size: int, no_negatives_mode: NO_NEGATIVES_MODES
+):
+    pairwise_dist, _, dist_std = _full_positive_sampling(input_space_X)
+
+    # the first point is at the origin, and all other points are roughly orthogonal with
+    # the same norm, so the first point is closer to every other point than any other
+    # point is to its positive -> the first anchor does not have any negative choices
+    generator = torch.Generator().manual_seed(2)
+    output_embed_X = 10.0 * torch.eye(NUM_POINTS, dtype=torch.float64)
+    output_embed_X += torch.rand(
+        output_embed_X.shape, generator=generator, dtype=torch.float64
+    )
+    output_embed_X[0] = 0.0
+
+    # the first point is not the positive of any other point
+    pos_idx = torch.arange(1, NUM_POINTS + 1)
+    pos_idx[-1] = 1
+
+    _check_negative_sampling(
+        input_space_X=input_space_X,
+        pairwise_dist=pairwise_dist,
+        dist_std=dist_std,
+        output_embed_X=output_embed_X,
+        pos_idx=pos_idx,
+        block_size=block_size,
+        no_negatives_mode=no_negatives_mode,
+    )
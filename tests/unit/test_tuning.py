@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import tables as tb
+from lightning_cv import CrossValidationTrainerConfig
+
+from pst.data.config import CrossValDataConfig
+from pst.data.modules import CrossValGenomeDataModule
+from pst.nn.config import GenomeTripletLossModelConfig
+from pst.nn.modules import ProteinSetTransformer
+from pst.training.tuning.tuning import _PatchedTuner
+
+IN_DIM = 16
+SIZES = [3, 5, 2, 4, 6, 3]
+
+
+@pytest.fixture
+def data_file(tmp_path: Path) -> Path:
+    rng = np.random.default_rng(0)
+    n_proteins = sum(SIZES)
+    file = tmp_path / "data.graphfmt.h5"
+    with tb.open_file(file, "w") as fp:
+        fp.create_carray(
+            "/", "data", obj=rng.standard_normal((n_proteins, IN_DIM)).astype(np.float32)
+        )
+        fp.create_carray("/", "sizes", obj=np.array(SIZES, dtype=np.int64))
+        fp.create_carray("/", "ptr", obj=np.cumsum([0, *SIZES], dtype=np.int64))
+        fp.create_carray(
+            "/", "strand", obj=rng.choice([-1, 1], size=n_proteins).astype(np.int64)
+        )
+        fp.create_carray("/", "class_id", obj=np.arange(len(SIZES), dtype=np.int64) % 3)
+
+    return file
+
+
+@pytest.fixture
+def tuner(data_file: Path, tmp_path: Path) -> _PatchedTuner:
+    return _PatchedTuner(
+        model_type=ProteinSetTransformer,
+        model_config=GenomeTripletLossModelConfig(in_dim=IN_DIM, num_heads=4),
+        datamodule_type=CrossValGenomeDataModule,
+        datamodule_config=CrossValDataConfig(file=data_file, batch_size=2),
+        trainer_config=CrossValidationTrainerConfig(checkpoint_dir=tmp_path),
+        logdir=tmp_path / "logs",
+    )
+
+
+def test_dataset_shared_across_batch_size_trials(tuner: _PatchedTuner):
+    tuner.trial_updater.update({"data": {"batch_size": 2}})
+    first = tuner._create_datamodule()
+
+    tuner.trial_updater.update({"data": {"batch_size": 4}})
+    second = tuner._create_datamodule()
+
+    assert second.dataset is first.dataset
+    assert second.config.batch_size == 4
+    assert "weight" in second.dataset._registered_features
+
+
+def test_dataset_reloaded_when_data_field_changes(tuner: _PatchedTuner):
+    tuner.trial_updater.update({"data": {"chunk_size": 30}})
+    first = tuner._create_datamodule()
+
+    tuner.trial_updater.update({"data": {"chunk_size": 10}})
+    second = tuner._create_datamodule()
+
+    assert second.dataset is not first.dataset
+    assert second.config.chunk_size == 10
+    assert "weight" in second.dataset._registered_features